@@ -1,11 +1,13 @@
-from sqlalchemy import Column, UniqueConstraint, ForeignKey
-from sqlalchemy import Integer
-from sqlalchemy import String
+from time import perf_counter
+from sqlalchemy import Column, UniqueConstraint, ForeignKey, event
+from sqlalchemy import Integer, Float, Boolean
+from sqlalchemy import String, LargeBinary
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy.orm import sessionmaker
 from app.settings import config
+from app.sys import metrics
 
 Base = declarative_base()
 
@@ -16,7 +18,7 @@ class Org(Base):
     org_rn = Column(Integer, nullable=False)
     org_code = Column(String, nullable=False)
     org_name = Column(String, nullable=False)
-    org_inn = Column(String, nullable=False)
+    org_inn = Column(String, nullable=False, index=True)
     company_rn = Column(Integer, nullable=False)
     db_key = Column(String, nullable=False)
     users = relationship('User', backref='org')
@@ -31,7 +33,7 @@ class User(Base):
     user_first_name = Column(String)
     user_last_name = Column(String)
     org_inn = Column(String)
-    org_id = Column(Integer, ForeignKey(Org.id))
+    org_id = Column(Integer, ForeignKey(Org.id), index=True)
     person_rn = Column(Integer)
     family = Column(String)
     firstname = Column(String)
@@ -40,6 +42,99 @@ class User(Base):
     __table_args__ = (UniqueConstraint('user_id', name='_user_user_id_uc'),)
 
 
+class OrgGroups(Base):
+    __tablename__ = 'org_groups'
+    id = Column(Integer, primary_key=True)
+    db_key = Column(String, nullable=False)
+    org_rn = Column(Integer, nullable=False)
+    groups = Column(String, nullable=False)
+    updated_at = Column(Float, nullable=False)
+    __table_args__ = (UniqueConstraint('db_key', 'org_rn', name='_org_groups_db_key_org_rn_uc'),)
+
+
+class PersonLookup(Base):
+    __tablename__ = 'person_lookup'
+    id = Column(Integer, primary_key=True)
+    db_key = Column(String, nullable=False)
+    org_rn = Column(Integer, nullable=False)
+    fio = Column(String, nullable=False)
+    person_rn = Column(Integer)
+    updated_at = Column(Float, nullable=False)
+    __table_args__ = (UniqueConstraint('db_key', 'org_rn', 'fio', name='_person_lookup_db_key_org_rn_fio_uc'),)
+
+
+class UploadJob(Base):
+    __tablename__ = 'upload_job'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    chat_id = Column(Integer, nullable=False)
+    message_id = Column(Integer)
+    db_key = Column(String, nullable=False)
+    org_rn = Column(Integer, nullable=False)
+    company_rn = Column(Integer, nullable=False)
+    filename = Column(String, nullable=False)
+    content = Column(LargeBinary, nullable=False)
+    sha256 = Column(String)
+    batch_id = Column(Integer)
+    batch_index = Column(Integer)
+    status = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    worker = Column(String)
+    lease_until = Column(Float)
+    not_before = Column(Float, nullable=False)
+    created_at = Column(Float, nullable=False)
+
+
+class UploadLedger(Base):
+    __tablename__ = 'upload_ledger'
+    id = Column(Integer, primary_key=True)
+    db_key = Column(String, nullable=False)
+    org_rn = Column(Integer, nullable=False)
+    sha256 = Column(String, nullable=False)
+    result = Column(String)
+    created_at = Column(Float, nullable=False)
+    __table_args__ = (UniqueConstraint('db_key', 'org_rn', 'sha256', name='_upload_ledger_db_key_org_rn_sha256_uc'),)
+
+
+class UploadBatch(Base):
+    __tablename__ = 'upload_batch'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    chat_id = Column(Integer, nullable=False)
+    message_id = Column(Integer)
+    filename = Column(String, nullable=False)
+    total = Column(Integer, nullable=False)
+    created_at = Column(Float, nullable=False)
+
+
+class UploadBatchResult(Base):
+    __tablename__ = 'upload_batch_result'
+    id = Column(Integer, primary_key=True)
+    batch_id = Column(Integer, nullable=False)
+    batch_index = Column(Integer, nullable=False)
+    filename = Column(String, nullable=False)
+    success = Column(Boolean, nullable=False)
+    text = Column(String, nullable=False)
+    __table_args__ = (UniqueConstraint('batch_id', 'batch_index', name='_upload_batch_result_batch_index_uc'),)
+
+
+class FsmState(Base):
+    __tablename__ = 'fsm_state'
+    chat = Column(String, primary_key=True)
+    user = Column(String, primary_key=True)
+    state = Column(String)
+    data = Column(String, nullable=False)
+    updated_at = Column(Float, nullable=False)
+
+
+class FsmBlob(Base):
+    __tablename__ = 'fsm_blob'
+    chat = Column(String, primary_key=True)
+    user = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    value = Column(LargeBinary, nullable=False)
+
+
 class SqliteAccessor:
     def __init__(self) -> None:
         self.engine = None
@@ -47,14 +142,38 @@ class SqliteAccessor:
 
     async def on_connect(self):
         self.engine = create_async_engine(
-            f'sqlite+aiosqlite:///{config["sqlite"]["database"]}?cache=shared',
+            f'sqlite+aiosqlite:///{config["sqlite"]["database"]}',
             echo=config['sqlite']['echo'],
         )
+        event.listen(self.engine.sync_engine, 'connect', _on_sqlite_connect)
+        event.listen(self.engine.sync_engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(self.engine.sync_engine, 'after_cursor_execute', _after_cursor_execute)
+        from app.store.cache.migrations import migrate
         async with self.engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(migrate)
         self.session = sessionmaker(
             self.engine, expire_on_commit=False, class_=AsyncSession
         )
 
     async def on_disconnect(self):
         await self.engine.dispose()
+
+
+def _on_sqlite_connect(dbapi_connection, _):
+    # Профиль соединения: журнал WAL для нескольких процессов, ожидание снятия блокировки,
+    # отображение файла базы в память и размер кэша страниц
+    cursor = dbapi_connection.cursor()
+    for pragma, value in config['sqlite']['pragmas'].items():
+        cursor.execute(f'PRAGMA {pragma}={value}')
+    cursor.close()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Время начала хранится в контексте выполнения: при ошибке запроса контекст отбрасывается вместе с ним
+    context.query_started = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Метка operation - первое слово запроса: select, insert, update, delete, pragma
+    elapsed = perf_counter() - context.query_started
+    metrics.sqlite_seconds.labels(statement[:6].lower()).observe(elapsed)
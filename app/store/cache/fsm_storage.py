@@ -0,0 +1,168 @@
+import asyncio
+import json
+import logging
+import typing
+from time import time
+
+from aiogram.dispatcher.storage import BaseStorage
+from sqlalchemy import delete, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.future import select
+from app.settings import config
+from app.store.cache.accessor import FsmState, FsmBlob
+from app.store.cache.models import db
+from tools.ttl_cache import TTLCache
+
+# Признак отсутствия записи в кэше в отличие от закэшированного None
+_missing = object()
+
+
+class SqliteStorage(BaseStorage):
+    """
+    Хранилище состояний конечного автомата в кэше SQLite.
+    Значения bytes из данных состояния (например, табель, ожидающий авторизации) хранятся
+    в отдельной таблице и не читаются при проверке состояния.
+    В памяти хранятся только последние состояния в кэше ограниченного размера.
+    Состояния, не изменявшиеся дольше ttl, удаляются периодической очисткой
+    """
+
+    def __init__(self):
+        self.ttl = config['fsm']['ttl']
+        self.states = TTLCache(config['fsm']['state_cache_size'], self.ttl)
+        self._sweeper = None
+
+    def start_sweeper(self):
+        """Запуск периодической очистки устаревших состояний"""
+        self._sweeper = asyncio.ensure_future(self._sweep_forever())
+
+    async def close(self):
+        if self._sweeper:
+            self._sweeper.cancel()
+
+    async def wait_closed(self):
+        if self._sweeper:
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+    def _address(self, chat, user) -> tuple[str, str]:
+        chat, user = self.check_address(chat=chat, user=user)
+        return str(chat), str(user)
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        address = self._address(chat, user)
+        state = self.states.get(address, _missing)
+        if state is _missing:
+            async with db.session() as session:
+                stmt = select(FsmState.state).where(address[0] == FsmState.chat, address[1] == FsmState.user)
+                result = await session.execute(stmt)
+                state = result.scalar()
+            self.states.set(address, state)
+        return state if state is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        address = self._address(chat, user)
+        async with db.session() as session:
+            stmt = select(FsmState.data).where(address[0] == FsmState.chat, address[1] == FsmState.user)
+            result = await session.execute(stmt)
+            data = result.scalar()
+            if data is None:
+                return dict(default or {})
+            data = json.loads(data)
+            blob_keys = data.pop('__blobs__', [])
+            if blob_keys:
+                stmt = select(FsmBlob.key, FsmBlob.value).where(
+                    address[0] == FsmBlob.chat, address[1] == FsmBlob.user)
+                result = await session.execute(stmt)
+                data.update({key: value for key, value in result.all()})
+        return data
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        address = self._address(chat, user)
+        state = self.resolve_state(state)
+        async with db.session() as session:
+            stmt = sqlite_insert(FsmState).values(
+                chat=address[0], user=address[1], state=state, data='{}', updated_at=time())
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[FsmState.chat, FsmState.user],
+                set_={'state': stmt.excluded.state, 'updated_at': stmt.excluded.updated_at},
+            )
+            await session.execute(stmt)
+            await session.commit()
+        self.states.set(address, state)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        address = self._address(chat, user)
+        data = dict(data or {})
+        blobs = {key: value for key, value in data.items() if isinstance(value, (bytes, bytearray))}
+        for key in blobs:
+            del data[key]
+        if blobs:
+            data['__blobs__'] = list(blobs)
+        async with db.session() as session:
+            stmt = sqlite_insert(FsmState).values(
+                chat=address[0], user=address[1], state=None, data=json.dumps(data), updated_at=time())
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[FsmState.chat, FsmState.user],
+                set_={'data': stmt.excluded.data, 'updated_at': stmt.excluded.updated_at},
+            )
+            await session.execute(stmt)
+            await session.execute(delete(FsmBlob).where(address[0] == FsmBlob.chat, address[1] == FsmBlob.user))
+            for key, value in blobs.items():
+                session.add(FsmBlob(chat=address[0], user=address[1], key=key, value=bytes(value)))
+            await session.commit()
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        current = await self.get_data(chat=chat, user=user)
+        current.update(data or {}, **kwargs)
+        await self.set_data(chat=chat, user=user, data=current)
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        if not with_data:
+            await self.set_state(chat=chat, user=user, state=None)
+            return
+        address = self._address(chat, user)
+        async with db.session() as session:
+            await session.execute(delete(FsmBlob).where(address[0] == FsmBlob.chat, address[1] == FsmBlob.user))
+            await session.execute(delete(FsmState).where(address[0] == FsmState.chat, address[1] == FsmState.user))
+            await session.commit()
+        self.states.set(address, None)
+
+    async def sweep(self) -> int:
+        """
+        Удаление состояний, не изменявшихся дольше ttl, вместе с их данными
+        :return: количество удалённых состояний
+        """
+        expired = select(FsmState.chat, FsmState.user).where(FsmState.updated_at < time() - self.ttl)
+        async with db.session() as session:
+            await session.execute(delete(FsmBlob).where(tuple_(FsmBlob.chat, FsmBlob.user).in_(expired)))
+            result = await session.execute(delete(FsmState).where(FsmState.updated_at < time() - self.ttl))
+            await session.commit()
+        return result.rowcount
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(config['fsm']['sweep_interval'])
+            try:
+                count = await self.sweep()
+                if count:
+                    logging.info(f'Удалено устаревших состояний: {count}')
+            except Exception as error:
+                logging.error(f'Ошибка очистки состояний: {error}')
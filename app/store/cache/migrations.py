@@ -0,0 +1,77 @@
+"""
+Версионные миграции схемы кэша SQLite
+Версия схемы хранится в PRAGMA user_version. Миграции выполняются по возрастанию версии
+и должны быть идемпотентными: на новой базе версия 1 уже создаёт таблицы в актуальном виде
+"""
+
+import logging
+from app.store.cache.accessor import Base, Org, User, PersonLookup, UploadJob, UploadLedger, UploadBatch, \
+    UploadBatchResult
+
+
+def _create_tables(connection):
+    Base.metadata.create_all(connection)
+
+
+def _create_hot_path_indexes(connection):
+    # org.org_inn - поиск учреждений по ИНН, user.org_id - соединение пользователя с учреждением
+    for index in (*Org.__table__.indexes, *User.__table__.indexes):
+        index.create(connection, checkfirst=True)
+
+
+def _create_person_lookup(connection):
+    # Результаты поиска сотрудников по ФИО
+    PersonLookup.__table__.create(connection, checkfirst=True)
+
+
+def _create_upload_job(connection):
+    # Очередь загрузки табелей в Парус
+    UploadJob.__table__.create(connection, checkfirst=True)
+
+
+def _create_upload_ledger(connection):
+    # Журнал загруженных табелей по хешу содержимого и хеш в задании очереди загрузки
+    UploadLedger.__table__.create(connection, checkfirst=True)
+    columns = [row[1] for row in connection.exec_driver_sql('PRAGMA table_info(upload_job)')]
+    if 'sha256' not in columns:
+        connection.exec_driver_sql('ALTER TABLE upload_job ADD COLUMN sha256 VARCHAR')
+
+
+def _create_upload_batch(connection):
+    # Архивы табелей, загружаемые через очередь с одним отчётом, и задания очереди из архивов
+    UploadBatch.__table__.create(connection, checkfirst=True)
+    UploadBatchResult.__table__.create(connection, checkfirst=True)
+    columns = [row[1] for row in connection.exec_driver_sql('PRAGMA table_info(upload_job)')]
+    for column in ('batch_id', 'batch_index'):
+        if column not in columns:
+            connection.exec_driver_sql(f'ALTER TABLE upload_job ADD COLUMN {column} INTEGER')
+
+
+MIGRATIONS = [
+    (1, _create_tables),
+    (2, _create_hot_path_indexes),
+    (3, _create_person_lookup),
+    (4, _create_upload_job),
+    (5, _create_upload_ledger),
+    (6, _create_upload_batch),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(connection) -> int:
+    return connection.exec_driver_sql('PRAGMA user_version').scalar()
+
+
+def migrate(connection):
+    """
+    Обновление схемы до последней версии
+    :param connection: синхронное соединение SQLAlchemy
+    """
+    version = get_version(connection)
+    if version == SCHEMA_VERSION:
+        return
+    for migration_version, migration in MIGRATIONS:
+        if migration_version > version:
+            logging.info(f'Миграция схемы кэша до версии {migration_version}')
+            migration(connection)
+            connection.exec_driver_sql(f'PRAGMA user_version={migration_version}')
@@ -1,75 +1,512 @@
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from time import time
 from typing import Optional
 
-from sqlalchemy import exc, delete, update, insert
+from sqlalchemy import delete, update, insert, exists, func, or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.future import select
-from app.store.cache.accessor import SqliteAccessor, User, Org
-from app.store.cache.tools import row_to_dict, rows_to_list
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.settings import config
+from app.sys import metrics
+from app.store.cache.accessor import SqliteAccessor, User, Org, OrgGroups, PersonLookup, UploadJob, \
+    UploadLedger, UploadBatch, UploadBatchResult
+from app.store.cache.tools import entity_to_dict, row_to_dict, rows_to_list
+from tools.ttl_cache import TTLCache
 
 db = SqliteAccessor()
+# Кэш пользователей и их учреждений в памяти по идентификатору пользователя Telegram
+users = TTLCache(config['sqlite']['cache_size'], config['sqlite']['cache_ttl'])
+user_orgs = TTLCache(config['sqlite']['cache_size'], config['sqlite']['cache_ttl'])
+# Признак отсутствия записи в кэше в отличие от закэшированного None
+_missing = object()
+# Сессия, общая для всех запросов в рамках обработки одного обновления Telegram
+_unit_of_work: ContextVar[Optional[AsyncSession]] = ContextVar('unit_of_work', default=None)
+
+
+async def open_unit_of_work():
+    """
+    Открытие общей сессии для обработки обновления
+    :return: кортеж (сессия, токен контекста) для передачи в close_unit_of_work
+    """
+    session = db.session()
+    return session, _unit_of_work.set(session)
+
+
+async def close_unit_of_work(session, token):
+    """Закрытие общей сессии обработки обновления"""
+    _unit_of_work.reset(token)
+    await session.close()
+
+
+@asynccontextmanager
+async def _session():
+    session = _unit_of_work.get()
+    if session is None:
+        async with db.session() as session:
+            yield session
+    else:
+        # Транзакция общей сессии не удерживается между запросами, чтобы не блокировать запись в SQLite
+        try:
+            yield session
+        except BaseException:
+            await session.rollback()
+            raise
+        else:
+            await session.commit()
 
 
 async def get_orgs(org_inn) -> list[dict]:
-    async with db.session() as session:
+    async with _session() as session:
         stmt = select(Org).where(org_inn == Org.org_inn)
         result = await session.execute(stmt)
         return rows_to_list(result)
 
 
 async def get_org(org_code, org_inn) -> Optional[dict]:
-    async with db.session() as session:
-        stmt = select(Org).where(org_code == Org.org_code and org_inn == Org.org_inn)
+    async with _session() as session:
+        stmt = select(Org).where(org_code == Org.org_code, org_inn == Org.org_inn)
         result = await session.execute(stmt)
         return row_to_dict(result.first())
 
 
-async def insert_org(org):
-    async with db.session() as session:
-        async with session.begin():
-            session.add(Org(**org))
-        try:
-            await session.commit()
-        except exc.SQLAlchemyError:
-            pass
+async def upsert_orgs(orgs) -> list[dict]:
+    """
+    Сохранение учреждений одной транзакцией: новые добавляются, существующие обновляются
+    :param orgs: список учреждений из веб-сервиса
+    :return: список сохранённых учреждений с идентификаторами
+    """
+    if not orgs:
+        return []
+    async with _session() as session:
+        stmt = sqlite_insert(Org).values(orgs)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Org.org_code, Org.org_inn],
+            set_={column: stmt.excluded[column] for column in ('org_rn', 'org_name', 'company_rn', 'db_key')},
+        ).returning(Org)
+        result = await session.execute(stmt)
+        saved = rows_to_list(result.all())
+        await session.commit()
+    # Реквизиты учреждений могли измениться
+    user_orgs.clear()
+    return saved
 
 
-async def insert_orgs(orgs):
-    for o in orgs:
-        await insert_org(o)
+async def get_groups(db_key, org_rn, max_age) -> Optional[list[str]]:
+    """
+    Получение сохранённого списка групп учреждения
+    :param max_age: максимальный возраст списка в секундах
+    :return: список групп либо None, если список не сохранён или устарел
+    """
+    async with _session() as session:
+        stmt = select(OrgGroups).where(db_key == OrgGroups.db_key, org_rn == OrgGroups.org_rn)
+        result = await session.execute(stmt)
+        row = row_to_dict(result.first())
+    if row and time() - row['updated_at'] < max_age:
+        return row['groups'].split(';')
+    else:
+        return None
+
+
+async def save_groups(db_key, org_rn, groups):
+    """Сохранение списка групп учреждения"""
+    async with _session() as session:
+        stmt = sqlite_insert(OrgGroups).values(
+            db_key=db_key, org_rn=org_rn, groups=';'.join(groups), updated_at=time())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[OrgGroups.db_key, OrgGroups.org_rn],
+            set_={'groups': stmt.excluded.groups, 'updated_at': stmt.excluded.updated_at},
+        )
+        await session.execute(stmt)
+        await session.commit()
+
+
+async def delete_groups(db_key, org_rn):
+    """Удаление сохранённого списка групп учреждения"""
+    async with _session() as session:
+        stmt = delete(OrgGroups).where(db_key == OrgGroups.db_key, org_rn == OrgGroups.org_rn)
+        await session.execute(stmt)
+        await session.commit()
+
+
+async def get_person(db_key, org_rn, fio, query, max_age, negative_max_age) -> tuple[bool, Optional[int]]:
+    """
+    Получение сохранённого результата поиска сотрудника. Найденный сотрудник хранится под нормализованными ФИО,
+    отрицательный результат - под ФИО в том виде, в котором они отправлены в Парус: поиск с другим регистром
+    или с ё вместо е мог бы найти сотрудника
+    :param fio: нормализованные ФИО
+    :param query: ФИО, отправляемые в Парус
+    :param max_age: максимальный возраст найденного сотрудника в секундах
+    :param negative_max_age: максимальный возраст отрицательного результата в секундах
+    :return: (True, рег. номер сотрудника либо None - не найден) либо (False, None), если результат не сохранён
+    или устарел
+    """
+    async with _session() as session:
+        stmt = select(PersonLookup).where(
+            db_key == PersonLookup.db_key, org_rn == PersonLookup.org_rn, PersonLookup.fio.in_((fio, query)))
+        result = await session.execute(stmt)
+        rows = rows_to_list(result.all())
+    now = time()
+    for row in rows:
+        if row['person_rn'] and row['fio'] == fio and now - row['updated_at'] < max_age:
+            return True, row['person_rn']
+        if not row['person_rn'] and row['fio'] == query and now - row['updated_at'] < negative_max_age:
+            return True, None
+    return False, None
+
+
+async def save_person(db_key, org_rn, fio, person_rn):
+    """Сохранение результата поиска сотрудника, None - сотрудник не найден"""
+    async with _session() as session:
+        stmt = sqlite_insert(PersonLookup).values(
+            db_key=db_key, org_rn=org_rn, fio=fio, person_rn=person_rn, updated_at=time())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[PersonLookup.db_key, PersonLookup.org_rn, PersonLookup.fio],
+            set_={'person_rn': stmt.excluded.person_rn, 'updated_at': stmt.excluded.updated_at},
+        )
+        await session.execute(stmt)
+        await session.commit()
+
+
+def _copy(row) -> Optional[dict]:
+    # Вызывающий код изменяет полученные словари, поэтому из кэша отдаются копии
+    return dict(row) if row else row
+
+
+def _invalidate_user(user_id):
+    users.pop(user_id)
+    user_orgs.pop(user_id)
+
+
+def cache_stats() -> dict:
+    """Статистика попаданий и промахов кэша пользователей и их учреждений"""
+    return {'users': users.stats(), 'user_orgs': user_orgs.stats()}
+
+
+metrics.CallbackMetric(
+    'tsheebot_user_cache_total', 'Попадания и промахи кэша пользователей и их учреждений', ['cache', 'result'],
+    lambda: [((name, result), stats[result])
+             for name, stats in cache_stats().items() for result in ('hits', 'misses')],
+    type='counter')
+metrics.CallbackMetric(
+    'tsheebot_user_cache_size', 'Размер кэша пользователей и их учреждений', ['cache'],
+    lambda: [((name,), stats['size']) for name, stats in cache_stats().items()])
 
 
 async def get_user(user_id) -> Optional[dict]:
-    async with db.session() as session:
+    user = users.get(user_id, _missing)
+    if user is not _missing:
+        return _copy(user)
+    async with _session() as session:
         stmt = select(User).where(user_id == User.user_id)
         result = await session.execute(stmt)
-        return row_to_dict(result.first())
+        user = row_to_dict(result.first())
+    users.set(user_id, user)
+    return _copy(user)
 
 
 async def get_user_org(user_id) -> Optional[dict]:
-    async with db.session() as session:
+    org = user_orgs.get(user_id, _missing)
+    if org is not _missing:
+        return _copy(org)
+    async with _session() as session:
         stmt = select(Org).join(User).where(user_id == User.user_id)
         result = await session.execute(stmt)
-        return row_to_dict(result.first())
+        org = row_to_dict(result.first())
+    user_orgs.set(user_id, org)
+    return _copy(org)
+
+
+async def get_user_context(user_id) -> tuple[Optional[dict], Optional[dict]]:
+    """
+    Получение пользователя и его учреждения одним запросом
+    :param user_id: идентификатор пользователя Telegram
+    :return: кортеж (пользователь, учреждение)
+    """
+    user = users.get(user_id, _missing)
+    org = user_orgs.get(user_id, _missing)
+    if user is _missing or org is _missing:
+        async with _session() as session:
+            stmt = select(User, Org).outerjoin(Org, User.org_id == Org.id).where(user_id == User.user_id)
+            result = await session.execute(stmt)
+            row = result.first()
+        user, org = (entity_to_dict(row[0]), entity_to_dict(row[1])) if row else (None, None)
+        users.set(user_id, user)
+        user_orgs.set(user_id, org)
+    return _copy(user), _copy(org)
 
 
 async def insert_user(user):
-    async with db.session() as session:
-        async with session.begin():
-            stmt = insert(User).values(**user)
-            await session.execute(stmt)
+    """
+    Создание пользователя; существующий пользователь, например после недоступности Паруса при вводе ИНН,
+    перезаписывается с начала авторизации
+    """
+    async with _session() as session:
+        stmt = sqlite_insert(User).values(**user)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.user_id],
+            set_={column.name: stmt.excluded[column.name] if column.name in user else None
+                  for column in User.__table__.columns if column.name not in ('id', 'user_id')},
+        )
+        await session.execute(stmt)
         await session.commit()
+    _invalidate_user(user['user_id'])
 
 
 async def update_user(user):
-    async with db.session() as session:
-        async with session.begin():
-            stmt = update(User).values(**user).where(user['user_id'] == User.user_id)
-            await session.execute(stmt)
+    async with _session() as session:
+        stmt = update(User).values(**user).where(user['user_id'] == User.user_id)
+        await session.execute(stmt)
         await session.commit()
+    _invalidate_user(user['user_id'])
 
 
 async def delete_user(user_id):
-    async with db.session() as session:
-        async with session.begin():
-            stmt = delete(User).where(user_id == User.user_id)
-            await session.execute(stmt)
+    async with _session() as session:
+        stmt = delete(User).where(user_id == User.user_id)
+        await session.execute(stmt)
+        await session.commit()
+    _invalidate_user(user_id)
+
+
+# Очередь загрузки табелей: строка существует, пока табель не загружен в Парус.
+# Задание выполняется под арендой до lease_until, по истечении аренды (процесс остановлен) оно возвращается в очередь.
+# Задание, табель которого уже отправлялся в Парус, в очередь не возвращается: повтор может загрузить табель дважды
+QUEUED = 'queued'
+RUNNING = 'running'
+SENDING = 'sending'
+_jobs = UploadJob.__table__
+
+
+async def enqueue_upload(job) -> int:
+    """
+    Добавление табеля в очередь загрузки
+    :param job: user_id, chat_id, message_id, db_key, org_rn, company_rn, filename, content,
+    sha256, batch_id, batch_index
+    :return: номер задания
+    """
+    now = time()
+    async with _session() as session:
+        stmt = insert(_jobs).values(**job, status=QUEUED, attempts=0, not_before=now, created_at=now)
+        result = await session.execute(stmt)
+        await session.commit()
+        return result.inserted_primary_key[0]
+
+
+async def claim_upload(worker, lease, db_key_limit) -> Optional[dict]:
+    """
+    Взятие в работу самого раннего задания, готового к выполнению.
+    Задание пользователя не берётся, пока не выполнены его более ранние задания, кроме заданий того же архива,
+    и не берётся, если в базе данных Паруса уже выполняется db_key_limit заданий
+    :param worker: имя исполнителя
+    :param lease: время аренды в секундах
+    :return: задание либо None
+    """
+    now = time()
+    job = _jobs.alias('job')
+    prior = _jobs.alias('prior')
+    running = _jobs.alias('running')
+    candidate = (
+        select(job.c.id)
+        .where(
+            job.c.status == QUEUED,
+            job.c.not_before <= now,
+            ~exists().where(
+                prior.c.user_id == job.c.user_id, prior.c.id < job.c.id,
+                or_(job.c.batch_id.is_(None), prior.c.batch_id.is_(None), prior.c.batch_id != job.c.batch_id)),
+            select(func.count()).where(running.c.db_key == job.c.db_key, running.c.status.in_((RUNNING, SENDING)))
+            .scalar_subquery() < db_key_limit,
+        )
+        .order_by(job.c.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    stmt = (
+        update(_jobs)
+        .where(_jobs.c.id == candidate, _jobs.c.status == QUEUED)
+        .values(status=RUNNING, worker=worker, lease_until=now + lease, attempts=_jobs.c.attempts + 1)
+        .returning(*_jobs.c)
+    )
+    async with _session() as session:
+        result = await session.execute(stmt)
+        job = result.mappings().first()
+        await session.commit()
+    return dict(job) if job else None
+
+
+async def mark_upload_sending(job_id):
+    """Отметка задания перед отправкой табеля в Парус"""
+    async with _session() as session:
+        await session.execute(update(_jobs).where(_jobs.c.id == job_id).values(status=SENDING))
+        await session.commit()
+
+
+async def defer_upload(job_id, delay):
+    """Возврат задания в очередь с выполнением не раньше чем через delay секунд"""
+    async with _session() as session:
+        stmt = update(_jobs).where(_jobs.c.id == job_id).values(
+            status=QUEUED, worker=None, lease_until=None, not_before=time() + delay)
+        await session.execute(stmt)
+        await session.commit()
+
+
+async def delete_upload(job_id):
+    """Удаление выполненного задания"""
+    async with _session() as session:
+        await session.execute(delete(_jobs).where(_jobs.c.id == job_id))
+        await session.commit()
+
+
+async def requeue_expired_uploads() -> int:
+    """
+    Возврат в очередь заданий с истёкшей арендой
+    :return: количество возвращённых заданий
+    """
+    async with _session() as session:
+        stmt = update(_jobs).where(_jobs.c.status == RUNNING, _jobs.c.lease_until < time()).values(
+            status=QUEUED, worker=None, lease_until=None)
+        result = await session.execute(stmt)
+        await session.commit()
+        return result.rowcount
+
+
+async def take_lost_uploads() -> list[dict]:
+    """
+    Удаление заданий с истёкшей арендой, прерванных во время отправки табеля в Парус
+    :return: удалённые задания, результат загрузки которых неизвестен
+    """
+    async with _session() as session:
+        stmt = delete(_jobs).where(_jobs.c.status == SENDING, _jobs.c.lease_until < time()).returning(*_jobs.c)
+        result = await session.execute(stmt)
+        jobs = [dict(job) for job in result.mappings().all()]
+        await session.commit()
+        return jobs
+
+
+async def count_uploads() -> int:
+    """Количество заданий в очереди и в работе"""
+    async with _session() as session:
+        result = await session.execute(select(func.count()).select_from(_jobs))
+        return result.scalar()
+
+
+# Архивы табелей: результаты табелей архива накапливаются и отправляются пользователю одним отчётом,
+# когда получены результаты всех табелей
+async def create_upload_batch(batch) -> int:
+    """
+    Создание архива табелей
+    :param batch: user_id, chat_id, message_id, filename, total - количество табелей
+    :return: номер архива
+    """
+    async with _session() as session:
+        result = await session.execute(insert(UploadBatch).values(**batch, created_at=time()))
+        await session.commit()
+        return result.inserted_primary_key[0]
+
+
+async def save_upload_batch_result(batch_id, batch_index, filename, success, text):
+    """Сохранение результата загрузки табеля архива с номером batch_index"""
+    async with _session() as session:
+        stmt = sqlite_insert(UploadBatchResult).values(
+            batch_id=batch_id, batch_index=batch_index, filename=filename, success=success, text=text,
+        ).on_conflict_do_nothing()
+        await session.execute(stmt)
+        await session.commit()
+
+
+async def take_complete_upload_batch(batch_id) -> Optional[tuple[dict, list[dict]]]:
+    """
+    Удаление архива, если получены результаты всех его табелей.
+    Архив возвращается только одному из одновременно завершивших его исполнителей
+    :return: кортеж (архив, результаты табелей по порядку) либо None
+    """
+    results_count = select(func.count()).where(UploadBatchResult.batch_id == batch_id).scalar_subquery()
+    async with _session() as session:
+        stmt = delete(UploadBatch).where(UploadBatch.id == batch_id, UploadBatch.total <= results_count) \
+            .returning(*UploadBatch.__table__.c)
+        batch = (await session.execute(stmt)).mappings().first()
+        if batch is None:
+            await session.commit()
+            return None
+        stmt = select(UploadBatchResult).where(UploadBatchResult.batch_id == batch_id) \
+            .order_by(UploadBatchResult.batch_index)
+        results = rows_to_list(await session.execute(stmt))
+        await session.execute(delete(UploadBatchResult).where(UploadBatchResult.batch_id == batch_id))
+        await session.commit()
+        return dict(batch), results
+
+
+async def purge_upload_batches(max_age):
+    """Удаление архивов старше max_age секунд, отчёт по которым не был отправлен"""
+    expired = select(UploadBatch.id).where(UploadBatch.created_at < time() - max_age)
+    async with _session() as session:
+        await session.execute(delete(UploadBatchResult).where(UploadBatchResult.batch_id.in_(expired)))
+        await session.execute(delete(UploadBatch).where(UploadBatch.created_at < time() - max_age))
+        await session.commit()
+
+
+# Журнал загруженных табелей по хешу SHA-256 содержимого в кодировке cp1251.
+# Запись без результата - табель принят и ожидает загрузки
+async def get_upload_ledger(db_key, org_rn, sha256, window) -> Optional[dict]:
+    """
+    Поиск табеля в журнале
+    :param window: время в секундах, в течение которого повторная загрузка считается дубликатом
+    :return: запись журнала либо None
+    """
+    async with _session() as session:
+        stmt = select(UploadLedger).where(
+            db_key == UploadLedger.db_key, org_rn == UploadLedger.org_rn, sha256 == UploadLedger.sha256,
+            UploadLedger.created_at >= time() - window)
+        result = await session.execute(stmt)
+        return row_to_dict(result.first())
+
+
+async def claim_upload_ledger(db_key, org_rn, sha256, window) -> Optional[dict]:
+    """
+    Запись табеля в журнал перед загрузкой, если такой табель не загружался в течение window секунд.
+    Одновременные попытки записать один табель не могут обе получить None
+    :return: None - табель записан в журнал и его следует загрузить, иначе - прежняя запись журнала
+    """
+    now = time()
+    async with _session() as session:
+        stmt = sqlite_insert(UploadLedger).values(
+            db_key=db_key, org_rn=org_rn, sha256=sha256, result=None, created_at=now)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[UploadLedger.db_key, UploadLedger.org_rn, UploadLedger.sha256],
+            set_={'result': None, 'created_at': now},
+            where=UploadLedger.created_at < now - window,
+        )
+        result = await session.execute(stmt)
+        await session.commit()
+        if result.rowcount:
+            return None
+        stmt = select(UploadLedger).where(
+            db_key == UploadLedger.db_key, org_rn == UploadLedger.org_rn, sha256 == UploadLedger.sha256)
+        result = await session.execute(stmt)
+        return row_to_dict(result.first())
+
+
+async def save_upload_result(db_key, org_rn, sha256, result):
+    """Сохранение результата загрузки табеля в журнале"""
+    async with _session() as session:
+        stmt = update(UploadLedger).where(
+            db_key == UploadLedger.db_key, org_rn == UploadLedger.org_rn, sha256 == UploadLedger.sha256,
+        ).values(result=result)
+        await session.execute(stmt)
+        await session.commit()
+
+
+async def delete_upload_ledger(db_key, org_rn, sha256):
+    """Удаление табеля из журнала после неудачной загрузки, чтобы его можно было отправить повторно"""
+    async with _session() as session:
+        stmt = delete(UploadLedger).where(
+            db_key == UploadLedger.db_key, org_rn == UploadLedger.org_rn, sha256 == UploadLedger.sha256)
+        await session.execute(stmt)
+        await session.commit()
+
+
+async def purge_upload_ledger(window):
+    """Удаление записей журнала старше window секунд"""
+    async with _session() as session:
+        await session.execute(delete(UploadLedger).where(UploadLedger.created_at < time() - window))
         await session.commit()
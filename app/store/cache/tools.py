@@ -1,9 +1,8 @@
 from typing import Optional
 
 
-def row_to_dict(row) -> Optional[dict]:
-    if row:
-        (obj,) = row
+def entity_to_dict(obj) -> Optional[dict]:
+    if obj is not None:
         out = dict(obj.__dict__)
         del out['_sa_instance_state']
         return out
@@ -11,6 +10,14 @@ def row_to_dict(row) -> Optional[dict]:
         return None
 
 
+def row_to_dict(row) -> Optional[dict]:
+    if row:
+        (obj,) = row
+        return entity_to_dict(obj)
+    else:
+        return None
+
+
 def rows_to_list(rows) -> list[dict]:
     out = []
     if rows:
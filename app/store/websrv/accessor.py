@@ -0,0 +1,56 @@
+from time import perf_counter
+import aiohttp
+from app.settings import config, sslcontext
+from app.sys import metrics
+
+
+def _endpoint(url) -> str:
+    """Имя метода веб-сервиса - последний сегмент пути запроса"""
+    return url.path.rsplit('/', 1)[-1]
+
+
+async def _on_request_start(session, context, params):
+    context.started = perf_counter()
+
+
+async def _on_request_end(session, context, params):
+    endpoint = _endpoint(params.url)
+    metrics.websrv_seconds.labels(endpoint).observe(perf_counter() - context.started)
+    metrics.websrv_responses.labels(endpoint, params.response.status).inc()
+
+
+async def _on_request_exception(session, context, params):
+    metrics.websrv_errors.labels(_endpoint(params.url), type(params.exception).__name__).inc()
+
+
+def _trace_config() -> aiohttp.TraceConfig:
+    """Учёт длительности, статусов ответов и ошибок запросов к веб-сервису"""
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_request_end.append(_on_request_end)
+    trace_config.on_request_exception.append(_on_request_exception)
+    return trace_config
+
+
+class WebsrvAccessor:
+    def __init__(self) -> None:
+        self.session = None
+
+    async def on_connect(self):
+        # Пул постоянных соединений: TCP и TLS устанавливаются один раз и переиспользуются между запросами
+        connector = aiohttp.TCPConnector(
+            limit=config['websrv']['pool_size'],
+            limit_per_host=config['websrv']['pool_size_per_host'],
+            ttl_dns_cache=config['websrv']['dns_cache_ttl'],
+            keepalive_timeout=config['websrv']['keepalive_timeout'],
+            ssl=sslcontext,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=config['websrv']['timeout'],
+            connect=config['websrv']['connect_timeout'],
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector, timeout=timeout, trace_configs=[_trace_config()])
+
+    async def on_disconnect(self):
+        await self.session.close()
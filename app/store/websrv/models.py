@@ -1,74 +1,237 @@
+import asyncio
 import io
 import json
+from collections import Counter
+from contextlib import asynccontextmanager
+from functools import wraps
+from time import perf_counter
 from urllib.parse import unquote_plus
 import aiohttp
 from typing import Optional
-from app.settings import config, sslcontext
+from app.settings import config
+from app.store.websrv.accessor import WebsrvAccessor
+from tools.circuit_breaker import CircuitBreaker, CLOSED, HALF_OPEN, OPEN
+from tools.retry import retry, hedge, LatencyWindow
+from tools.spool import Spool
+from app.sys import metrics
 
 websrv_url = f'{config["websrv"]["url"]}/{config["websrv_token"]}'
+client = WebsrvAccessor()
 
 
-async def get_orgs(org_inn) -> list[dict]:
-    """Поиск Паруса, обслуживающего учреждение с заданным ИНН"""
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f'{websrv_url}/get_orgs?org_inn={org_inn}', ssl=sslcontext) as resp:
-            if resp.status == 200:
-                content = await resp.text()
-                return json.loads(content) if content and content != 'None' else []
+class WebsrvUnavailable(Exception):
+    """Парус учреждения не отвечает, перегружен, вернул ошибку или отключён выключателем"""
+
+    def __init__(self, db_key, reason, retryable=True, sent=True):
+        """
+        :param retryable: False - повтор бесполезен: выключатель разомкнут, очередь переполнена, ошибка запроса
+        :param sent: False - запрос отклонён до отправки в Парус и может быть безопасно отправлен позже
+        """
+        super().__init__('Парус учреждения временно недоступен, повторите попытку позже')
+        self.db_key = db_key
+        self.reason = reason
+        self.retryable = retryable
+        self.sent = sent
+
+
+# Ограничение одновременных запросов и выключатель для каждой базы данных Паруса,
+# поиск учреждений по ИНН выполняется без базы данных и учитывается под ключом None
+bulkheads: dict[Optional[str], asyncio.Semaphore] = {}
+in_flight = Counter()
+breakers: dict[Optional[str], CircuitBreaker] = {}
+# Тайм-аут запроса заменяет тайм-аут сессии целиком, поэтому тайм-аут соединения задаётся в каждом;
+# метод без собственного тайм-аута ограничивается общим websrv.timeout
+_timeouts = {endpoint: aiohttp.ClientTimeout(total=timeout, connect=config['websrv']['connect_timeout'])
+             for endpoint, timeout in config['websrv']['timeouts'].items()}
+_default_timeout = aiohttp.ClientTimeout(total=config['websrv']['timeout'], connect=config['websrv']['connect_timeout'])
+_breaker_states = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+def _label(db_key) -> str:
+    return '*' if db_key is None else db_key
+
+
+metrics.CallbackMetric(
+    'tsheebot_websrv_breaker_state', 'Состояние выключателя базы данных Паруса: 0 - замкнут, 1 - проба, 2 - разомкнут',
+    ['db_key'], lambda: [((_label(db_key),), _breaker_states[breaker.state]) for db_key, breaker in breakers.items()])
+metrics.CallbackMetric(
+    'tsheebot_websrv_in_flight', 'Запросы к базе данных Паруса в обработке', ['db_key'],
+    lambda: [((_label(db_key),), count) for db_key, count in in_flight.items()])
+
+
+def _breaker(db_key) -> CircuitBreaker:
+    breaker = breakers.get(db_key)
+    if breaker is None:
+        breaker = breakers[db_key] = CircuitBreaker(
+            f'Парус {_label(db_key)}',
+            config['websrv']['breaker_failures'],
+            config['websrv']['breaker_recovery'])
+    return breaker
+
+
+def _bulkhead(db_key) -> asyncio.Semaphore:
+    bulkhead = bulkheads.get(db_key)
+    if bulkhead is None:
+        bulkhead = bulkheads[db_key] = asyncio.Semaphore(config['websrv']['db_key_concurrency'])
+    return bulkhead
+
+
+@asynccontextmanager
+async def _request(method, endpoint, db_key, url, **kwargs):
+    """
+    Запрос к веб-сервису с ограничением одновременных запросов к базе данных Паруса,
+    тайм-аутом метода и выключателем.
+    Ошибки соединения, тайм-ауты и ответы 5xx считаются отказами Паруса
+    """
+    breaker = _breaker(db_key)
+    if not breaker.allow():
+        metrics.websrv_rejected.labels(endpoint, 'breaker').inc()
+        raise WebsrvUnavailable(db_key, 'выключатель разомкнут', retryable=False, sent=False)
+    bulkhead = _bulkhead(db_key)
+    try:
+        await asyncio.wait_for(bulkhead.acquire(), config['websrv']['db_key_queue_timeout'])
+    except asyncio.TimeoutError:
+        metrics.websrv_rejected.labels(endpoint, 'bulkhead').inc()
+        raise WebsrvUnavailable(db_key, 'превышено количество одновременных запросов', retryable=False,
+                                sent=False)
+    in_flight[db_key] += 1
+    try:
+        async with client.session.request(method, url, timeout=_timeouts.get(endpoint, _default_timeout), **kwargs) as resp:
+            if resp.status >= 500:
+                breaker.failure()
             else:
-                return []
+                breaker.success()
+            yield resp
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        breaker.failure()
+        raise WebsrvUnavailable(db_key, f'{endpoint}: {error!r}') from error
+    finally:
+        in_flight[db_key] -= 1
+        bulkhead.release()
+
+
+async def _lookup_content(resp, endpoint, db_key) -> Optional[str]:
+    """
+    Содержимое ответа на поиск
+    :return: текст ответа, None - не найдено
+    :raise WebsrvUnavailable: Парус вернул ошибку
+    """
+    if resp.status == 200:
+        content = await resp.text()
+        return content if content and content != 'None' else None
+    if resp.status == 404:
+        return None
+    raise WebsrvUnavailable(db_key, f'{endpoint}: {resp.status} {resp.reason}', retryable=resp.status >= 500)
 
 
+def _should_retry(endpoint, error) -> bool:
+    if isinstance(error, WebsrvUnavailable) and error.retryable:
+        metrics.websrv_retries.labels(endpoint).inc()
+        return True
+    return False
+
+
+def _idempotent(endpoint):
+    """
+    Повтор поиска после сбоя Паруса и дублирование запроса, не получившего ответ за время
+    квантиля длительности успешных запросов этого метода
+    """
+    retry_config = config['websrv']['retry']
+    hedge_config = config['websrv']['hedge']
+    latencies = LatencyWindow(hedge_config['window'], hedge_config['min_samples'])
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args):
+            async def attempt():
+                started = perf_counter()
+                result = await func(*args)
+                latencies.add(perf_counter() - started)
+                return result
+
+            async def hedged():
+                delay = latencies.quantile(hedge_config['quantile']) if hedge_config['enabled'] else None
+                return await hedge(attempt, delay)
+
+            return await retry(hedged, retry_config['attempts'], retry_config['base_delay'],
+                               retry_config['max_delay'], lambda error: _should_retry(endpoint, error))
+        return wrapper
+    return decorator
+
+
+@_idempotent('get_orgs')
+async def get_orgs(org_inn) -> list[dict]:
+    """
+    Поиск Паруса, обслуживающего учреждение с заданным ИНН
+    :return: учреждения, [] - учреждение не подключено
+    :raise WebsrvUnavailable: Парус не ответил после повторов
+    """
+    async with _request('GET', 'get_orgs', None, f'{websrv_url}/get_orgs?org_inn={org_inn}') as resp:
+        content = await _lookup_content(resp, 'get_orgs', None)
+        return json.loads(content) if content else []
+
+
+@_idempotent('get_person')
 async def get_person(db_key, org_rn, family, firstname, lastname) -> Optional[int]:
-    """Поиск сотрудника в учреждении"""
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f'{websrv_url}/get_person?'
-                               f'db_key={db_key}&org_rn={org_rn}&'
-                               f'family={family}&firstname={firstname}&lastname={lastname}', ssl=sslcontext) as resp:
-            if resp.status == 200:
-                content = await resp.text()
-                return int(content) if content and content != 'None' else None
-            else:
-                return None
+    """
+    Поиск сотрудника в учреждении
+    :return: рег. номер сотрудника, None - сотрудник не найден
+    :raise WebsrvUnavailable: Парус не ответил после повторов
+    """
+    async with _request('GET', 'get_person', db_key,
+                        f'{websrv_url}/get_person?'
+                        f'db_key={db_key}&org_rn={org_rn}&'
+                        f'family={family}&firstname={firstname}&lastname={lastname}') as resp:
+        content = await _lookup_content(resp, 'get_person', db_key)
+        return int(content) if content else None
 
 
+@_idempotent('get_groups')
 async def get_groups(db_key, org_rn) -> list[str]:
-    """Получение списка групп учреждения"""
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f'{websrv_url}/get_groups?'
-                               f'db_key={db_key}&org_rn={org_rn}', ssl=sslcontext) as resp:
-            if resp.status == 200:
-                content = await resp.text()
-                return content.split(';') if content and content != 'None' else []
-            else:
-                return []
+    """
+    Получение списка групп учреждения
+    :return: группы, [] - действующих групп нет
+    :raise WebsrvUnavailable: Парус не ответил после повторов
+    """
+    async with _request('GET', 'get_groups', db_key,
+                        f'{websrv_url}/get_groups?'
+                        f'db_key={db_key}&org_rn={org_rn}') as resp:
+        content = await _lookup_content(resp, 'get_groups', db_key)
+        return content.split(';') if content else []
 
 
 async def receive_timesheet(db_key, org_rn, group):
-    """Получение табеля посещаемости группы в формате CSV"""
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f'{websrv_url}/receive_timesheet?'
-                               f'db_key={db_key}&org_rn={org_rn}&group={group}', ssl=sslcontext) as resp:
-            if resp.status == 200:
-                reader = aiohttp.MultipartReader.from_response(resp)
-                part = await reader.next()
-                content = await part.read()
-                filename = unquote_plus(part.filename)
-                return content, filename, resp.status, resp.reason
-            else:
-                return None, None, resp.status, resp.reason
+    """
+    Получение табеля посещаемости группы в формате CSV
+    Табель читается частями: небольшой остаётся в памяти, большой записывается во временный файл
+    """
+    async with _request('GET', 'receive_timesheet', db_key,
+                        f'{websrv_url}/receive_timesheet?'
+                        f'db_key={db_key}&org_rn={org_rn}&group={group}') as resp:
+        if resp.status == 200:
+            reader = aiohttp.MultipartReader.from_response(resp)
+            part = await reader.next()
+            content = Spool(config['websrv']['spool_threshold'])
+            while chunk := await part.read_chunk(config['websrv']['chunk_size']):
+                content.write(chunk)
+            content.close()
+            metrics.timesheet_bytes.labels('download').observe(content.size)
+            filename = unquote_plus(part.filename)
+            return content, filename, resp.status, resp.reason
+        else:
+            return None, None, resp.status, resp.reason
 
 
 async def send_timesheet(db_key, company_rn, content, filename):
-    """Отправка табеля посещаемости группы в формате CSV в Парус"""
-    async with aiohttp.ClientSession() as session:
-        with aiohttp.MultipartWriter() as root:
-            part = root.append(io.BytesIO(content))
-            part.set_content_disposition('package', filename=filename)
-            async with session.post(
-                    f'{websrv_url}/send_timesheet?db_key={db_key}&company_rn={company_rn}',
-                    data=root,
-                    ssl=sslcontext,
-            ) as resp:
-                result = (await resp.content.read()).decode('utf-8')
-                return result
+    """
+    Отправка табеля посещаемости группы в формате CSV в Парус
+    Не повторяется автоматически: повтор после обрыва соединения может загрузить табель дважды
+    """
+    with aiohttp.MultipartWriter() as root:
+        part = root.append(io.BytesIO(content))
+        part.set_content_disposition('package', filename=filename)
+        async with _request('POST', 'send_timesheet', db_key,
+                            f'{websrv_url}/send_timesheet?db_key={db_key}&company_rn={company_rn}',
+                            data=root) as resp:
+            result = (await resp.content.read()).decode('utf-8')
+            return result
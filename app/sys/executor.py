@@ -0,0 +1,37 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from app.settings import config
+
+
+class CpuExecutor:
+    """
+    Пул потоков либо процессов для вычислений, которые не должны блокировать цикл событий.
+    Функции, выполняемые в пуле процессов, должны быть объявлены на уровне модуля
+    """
+
+    def __init__(self) -> None:
+        self.pool = None
+
+    async def on_connect(self):
+        workers = config['executor']['workers']
+        if config['executor']['kind'] == 'process':
+            self.pool = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tsheebot-cpu')
+
+    async def on_disconnect(self):
+        pool, self.pool = self.pool, None
+        await asyncio.get_running_loop().run_in_executor(None, partial(pool.shutdown, cancel_futures=True))
+
+    async def run(self, func, *args):
+        """
+        Выполнение функции в пуле
+        До подключения пула функция выполняется в цикле событий
+        """
+        if self.pool is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+
+
+executor = CpuExecutor()
@@ -0,0 +1,195 @@
+"""
+Метрики в текстовом формате Prometheus
+Дочерние метрики с метками создаются один раз и далее только изменяют свои значения
+"""
+
+from bisect import bisect_left
+from math import inf
+
+# Границы корзин гистограмм длительности в секундах и размера в байтах
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        registry.append(self)
+
+    def labels(self, *values):
+        """
+        Дочерняя метрика с заданными значениями меток
+        Для вызовов на горячем пути дочернюю метрику следует получить заранее
+        """
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _labels_text(self, values, extra=''):
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type}'
+        for values, child in list(self._children.items()):
+            yield from self._render_child(values, child)
+
+    def _render_child(self, values, child):
+        yield f'{self.name}{self._labels_text(values)} {child.value}'
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class CallbackMetric(_Metric):
+    """Метрика, значения которой вычисляются функцией при выдаче метрик"""
+
+    def __init__(self, name, documentation, labelnames, callback, type='gauge'):
+        """
+        :param callback: функция, возвращающая список пар (кортеж значений меток, значение)
+        :param type: тип метрики counter либо gauge
+        """
+        self.type = type
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type}'
+        for values, value in self.callback():
+            yield f'{self.name}{self._labels_text(values)} {value}'
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_child(self, values, child):
+        cumulative = 0
+        for bound, count in zip((*self.buckets, inf), child.counts):
+            cumulative += count
+            le = 'le="+Inf"' if bound == inf else f'le="{bound}"'
+            yield f'{self.name}_bucket{self._labels_text(values, le)} {cumulative}'
+        yield f'{self.name}_sum{self._labels_text(values)} {child.sum}'
+        yield f'{self.name}_count{self._labels_text(values)} {cumulative}'
+
+
+registry: list[_Metric] = []
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+
+async def metrics_handler(_):
+    """Обработчик маршрута /metrics"""
+    from aiohttp import web
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+
+# Метрики бота
+handler_seconds = Histogram(
+    'tsheebot_handler_seconds', 'Длительность обработчиков бота', ['handler'])
+updates_in_flight = Gauge(
+    'tsheebot_updates_in_flight', 'Обновления Telegram в обработке')
+websrv_seconds = Histogram(
+    'tsheebot_websrv_seconds', 'Длительность запросов к веб-сервису до получения заголовков ответа', ['endpoint'])
+websrv_responses = Counter(
+    'tsheebot_websrv_responses_total', 'Ответы веб-сервиса по статусу', ['endpoint', 'status'])
+websrv_errors = Counter(
+    'tsheebot_websrv_errors_total', 'Ошибки запросов к веб-сервису', ['endpoint', 'error'])
+websrv_rejected = Counter(
+    'tsheebot_websrv_rejected_total', 'Запросы к веб-сервису, отклонённые без обращения к Парусу',
+    ['endpoint', 'reason'])
+websrv_retries = Counter(
+    'tsheebot_websrv_retries_total', 'Повторы поиска в веб-сервисе после сбоя Паруса', ['endpoint'])
+sqlite_seconds = Histogram(
+    'tsheebot_sqlite_seconds', 'Длительность запросов к кэшу SQLite', ['operation'])
+timesheet_bytes = Histogram(
+    'tsheebot_timesheet_bytes', 'Размер табелей', ['direction'], buckets=SIZE_BUCKETS)
+timesheet_charset = Counter(
+    'tsheebot_timesheet_charset_total', 'Табели по способу определения кодировки', ['path'])
+send_wait_seconds = Histogram(
+    'tsheebot_send_wait_seconds', 'Ожидание в очереди отправки в Telegram', ['priority'])
+send_retry_after = Counter(
+    'tsheebot_send_retry_after_total', 'Ответы Telegram 429 с требованием повторить запрос позже')
+upload_jobs = Counter(
+    'tsheebot_upload_jobs_total', 'Задания очереди загрузки табелей по результату', ['result'])
+upload_wait_seconds = Histogram(
+    'tsheebot_upload_wait_seconds', 'Время от постановки табеля в очередь до результата загрузки')
+upload_duplicates = Counter(
+    'tsheebot_upload_duplicates_total', 'Повторные отправки табелей, не загруженные в Парус повторно')
@@ -19,7 +19,8 @@ def write_pid_file() -> int:
 
 
 def remove_pid_file() -> Optional[int]:
+    """Файл удаляется только своим процессом, поскольку при перезапуске его уже записал новый процесс"""
     pid = read_pid_file()
-    if pid:
+    if pid == os.getpid():
         os.remove(config['pid_file'])
     return pid
@@ -0,0 +1,59 @@
+import logging
+import os
+import signal
+import time
+
+
+def supervise(workers, target):
+    """
+    Запуск рабочих процессов и их перезапуск при аварийном завершении.
+    SIGINT и SIGTERM пересылаются рабочим процессам как SIGINT, SIGUSR2 передачи работы новому процессу
+    пересылается как есть, после чего ожидается завершение рабочих процессов
+    :param workers: количество рабочих процессов
+    :param target: функция рабочего процесса, принимающая его номер
+    """
+    children = {}
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+            code = 0
+            try:
+                target(index)
+            except BaseException:
+                logging.exception(f'Рабочий процесс {index} завершился с ошибкой')
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = index
+        logging.info(f'Рабочий процесс {index} запущен pid={pid}')
+
+    def stop(signum, _):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGUSR2 if signum == signal.SIGUSR2 else signal.SIGINT)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGUSR2, stop)
+    for index in range(workers):
+        spawn(index)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            logging.error(f'Рабочий процесс {index} pid={pid} завершился '
+                          f'с кодом {os.waitstatus_to_exitcode(status)}, перезапуск')
+            time.sleep(1)
+            spawn(index)
@@ -1,7 +1,11 @@
+import asyncio
+import hashlib
+import logging
 import os
+from datetime import datetime
 from io import BytesIO
 import aiogram.utils.markdown as md
-from aiogram import Bot, Dispatcher, types
+from aiogram import Dispatcher, types
 from aiogram.bot.api import TelegramAPIServer
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
@@ -11,11 +15,17 @@ from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import ParseMode, InputFile
 import app.store.websrv.models as websrv
 import app.store.cache.models as cache
+from app.store.cache.fsm_storage import SqliteStorage
 import app.tsheebot.models as tsheebot
+from app.tsheebot.middlewares import DrainMiddleware, MetricsMiddleware, UserContextMiddleware
+from app.tsheebot.sender import ThrottledBot
+from app.tsheebot.uploads import UploadQueue
+from tools.hashing import HashingBuffer
 from tools.helpers import split_fio, echo_error, keys_exists
-from tools.cp1251 import decode_cp1251, encode_cp1251
+from tools.timesheet import prepare_timesheet, list_archive_timesheets, prepare_archive_timesheets
+from app.sys.executor import executor
+from app.sys import metrics
 from app.settings import config
-from charset_normalizer import from_bytes
 
 
 # Команды бота
@@ -29,8 +39,13 @@ help - что может делать этот бот?'''
 
 # Aiogram Telegram Bot
 local_server = TelegramAPIServer.from_base(config['bot']['api_server_url'])
-bot = Bot(token=config['bot_token'], server=local_server)
-dp = Dispatcher(bot, storage=MemoryStorage())
+bot = ThrottledBot(token=config['bot_token'], server=local_server)
+dp = Dispatcher(bot, storage=SqliteStorage() if config['fsm']['storage'] == 'sqlite' else MemoryStorage())
+uploads = UploadQueue(bot)
+updates = DrainMiddleware()
+dp.middleware.setup(updates)
+dp.middleware.setup(MetricsMiddleware())
+dp.middleware.setup(UserContextMiddleware())
 
 
 # Состояния конечного автомата
@@ -41,41 +56,66 @@ class Form(StatesGroup):
     group = State()  # выбор группы учреждения
 
 
-async def receive_timesheet(message: types.Message, state: FSMContext):
+async def receive_timesheet(message: types.Message, state: FSMContext, user, org):
     """
     Получение табеля посещаемости из Паруса
     """
-    org = await cache.get_user_org(message.from_user.id)
-    user = await cache.get_user(message.from_user.id)
     if org and user['org_id'] and user['group']:
         try:
             # Получение табеля посещаемости из Паруса в файл CSV во временную директорию
             content, filename, status, reason = \
-                await websrv.receive_timesheet(org['db_key'], org['org_rn'], user['group'])
+                await tsheebot.receive_timesheet(org['db_key'], org['org_rn'], user['group'])
             # Отправка табеля посещаемости пользователю
             if status == 200:
-                await message.reply_document(
-                    InputFile(BytesIO(content), filename),
-                    caption=f'Учреждение: {org["org_name"]}\nГруппа: {user["group"]}',
-                    reply_markup=types.ReplyKeyboardRemove())
+                with content.open() as file:
+                    await message.reply_document(
+                        InputFile(file, filename),
+                        caption=f'Учреждение: {org["org_name"]}\nГруппа: {user["group"]}',
+                        reply_markup=types.ReplyKeyboardRemove())
             else:
+                # Группа могла быть удалена из учреждения
+                await tsheebot.invalidate_groups(org['db_key'], org['org_rn'])
                 raise Exception(f'{status} {reason}')
         except Exception as error:
             await echo_error(message, f'Ошибка получения табеля посещаемости из Паруса: {error}')
     else:
         # Авторизация и повторное получение табеля
-        await cmd_start(message, state)
+        await cmd_start(message, state, user, org)
     # Завершение команды
     await state.finish()
 
 
-async def send_timesheet(message: types.Message, state: FSMContext, content, filename):
-    """Отправка табеля посещаемости в Парус"""
-    org = await cache.get_user_org(message.from_user.id)
+def _duplicate_text(filename, previous) -> str:
+    """Ответ на повторную отправку табеля"""
+    if previous['result'] is None:
+        return f'Табель {filename} уже принят и ожидает загрузки в Парус'
+    loaded_at = datetime.fromtimestamp(previous['created_at']).strftime('%d.%m.%Y %H:%M')
+    return f'Табель {filename} уже загружен в Парус {loaded_at}: {previous["result"]}'
+
+
+async def send_timesheet(message: types.Message, state: FSMContext, org, content, filename, sha256=None):
+    """
+    Постановка табеля посещаемости в очередь загрузки в Парус.
+    Табель, уже загруженный в учреждение в течение uploads.dedup_window, повторно не загружается
+    :param sha256: хеш табеля в кодировке cp1251, если он уже вычислен
+    """
     if org:
-        # Отправка табеля
-        result = await websrv.send_timesheet(org['db_key'], org['company_rn'], content, filename)
-        await message.reply(result, reply_markup=types.ReplyKeyboardRemove())
+        sha256 = sha256 or hashlib.sha256(content).hexdigest()
+        previous = await cache.claim_upload_ledger(
+            org['db_key'], org['org_rn'], sha256, config['uploads']['dedup_window'])
+        if previous:
+            metrics.upload_duplicates.inc()
+            await message.reply(_duplicate_text(filename, previous), reply_markup=types.ReplyKeyboardRemove())
+        else:
+            # Результат загрузки придёт отдельным сообщением
+            try:
+                await uploads.put(message, org, content, filename, sha256)
+            except Exception:
+                # Табель не поставлен в очередь, поэтому его можно отправить повторно
+                await cache.delete_upload_ledger(org['db_key'], org['org_rn'], sha256)
+                raise
+            await message.reply(f'Табель {filename} принят, результат загрузки в Парус придёт отдельным сообщением',
+                                reply_markup=types.ReplyKeyboardRemove())
         await state.finish()
         return True
     else:
@@ -83,9 +123,8 @@ async def send_timesheet(message: types.Message, state: FSMContext, content, fil
 
 
 @dp.message_handler(commands='start')
-async def cmd_start(message: types.Message, state: FSMContext):
+async def cmd_start(message: types.Message, state: FSMContext, user, org):
     """Авторизация и отправка или получение табеля посещаемости из Паруса"""
-    user = await cache.get_user(message.from_user.id)
     if not user:
         # Обработка ИНН, если пользователь не авторизован
         await prompt_to_input_inn(message)
@@ -99,11 +138,11 @@ async def cmd_start(message: types.Message, state: FSMContext):
         await Form.fio.set()
     elif not user['group']:
         # Обработка группы, если её нет
-        await prompt_to_input_group(message, state)
+        await prompt_to_input_group(message, state, user, org)
         await Form.group.set()
     elif user['org_id'] and user['person_rn'] and user['group']:
         # Получение табеля посещаемости из Паруса
-        await receive_timesheet(message, state)
+        await receive_timesheet(message, state, user, org)
 
 
 @dp.message_handler(state='*', commands='cancel')
@@ -162,10 +201,9 @@ async def _process_orgs_by_inn(message: types.Message, state: FSMContext, user):
 
 
 @dp.message_handler(state=Form.org)
-async def process_org(message: types.Message, state: FSMContext):
+async def process_org(message: types.Message, state: FSMContext, user):
     """Обработка учреждения"""
     org_code = message.text
-    user = await cache.get_user(message.from_user.id)
     if not user['org_inn']:
         await prompt_to_input_inn(message)
         await Form.inn.set()
@@ -183,14 +221,12 @@ async def process_org(message: types.Message, state: FSMContext):
 
 
 @dp.message_handler(state=Form.fio)
-async def process_fio(message: types.Message, state: FSMContext):
+async def process_fio(message: types.Message, state: FSMContext, user, org):
     """Обработка ФИО"""
     fio = message.text
     family, firstname, lastname = split_fio(fio)
-    user = await cache.get_user(message.from_user.id)
-    org = await cache.get_user_org(message.from_user.id)
-    # Поиск сотрудника учреждения по ФИО в веб-сервисе
-    person_rn = await websrv.get_person(org['db_key'], org['org_rn'], family, firstname, lastname)
+    # Поиск сотрудника учреждения по ФИО в кэше либо в веб-сервисе
+    person_rn = await tsheebot.get_person(org['db_key'], org['org_rn'], family, firstname, lastname)
     # Сотрудник учреждения найден
     if person_rn:
         # Сохранение реквизитов сотрудника
@@ -202,13 +238,13 @@ async def process_fio(message: types.Message, state: FSMContext):
             content = data['content']
             filename = data['filename']
             if os.path.exists(filename):
-                await send_timesheet(message, state, content, filename)
+                await send_timesheet(message, state, org, content, filename)
                 del data['content']
                 del data['filename']
                 await state.set_data(data)
         # Обработка группы
         else:
-            await prompt_to_input_group(message, state)
+            await prompt_to_input_group(message, state, user, org)
             await Form.group.set()
     # Сотрудник не найден в Парусе
     else:
@@ -218,33 +254,31 @@ async def process_fio(message: types.Message, state: FSMContext):
 
 
 @dp.message_handler(state=Form.group)
-async def process_group(message: types.Message, state: FSMContext):
+async def process_group(message: types.Message, state: FSMContext, user, org):
     """
     Обработка группы
     """
-    user = await cache.get_user(message.from_user.id)
     if user:
         # Сохранение группы
         group = message.text
         user['group'] = group
         await cache.update_user(user)
         # Получение табеля посещаемости из Паруса
-        await receive_timesheet(message, state)
+        await receive_timesheet(message, state, user, org)
     else:
         # Авторизация
-        await cmd_start(message, state)
+        await cmd_start(message, state, user, org)
 
 
 @dp.message_handler(commands='group')
-async def cmd_group(message: types.Message, state: FSMContext):
+async def cmd_group(message: types.Message, state: FSMContext, user, org):
     """Выбор другой группы"""
     # Удаление группы
-    user = await cache.get_user(message.from_user.id)
     if user['group']:
         del user['group']
         await cache.update_user(user)
     # Обработка другой группы
-    await prompt_to_input_group(message, state)
+    await prompt_to_input_group(message, state, user, org)
     await Form.group.set()
 
 
@@ -252,7 +286,7 @@ async def cmd_group(message: types.Message, state: FSMContext):
 async def cmd_org(message: types.Message, state: FSMContext):
     """Авторизация другого учреждения"""
     await cache.delete_user(message.from_user.id)
-    await cmd_start(message, state)
+    await cmd_start(message, state, None, None)
 
 
 @dp.message_handler(commands='reset')
@@ -297,29 +331,45 @@ async def cmd_help(message: types.Message):
 
 
 @dp.message_handler(content_types=ContentType.DOCUMENT)
-async def process_timesheet(message: types.Message, state: FSMContext):
+async def process_timesheet(message: types.Message, state: FSMContext, user, org):
     """Отправка табеля посещаемости в Парус"""
     # От пользователя получен файл с табелем посещаемости
     if message.document:
         filename = message.document['file_name']
         file_ext = os.path.splitext(filename)[1]
         if file_ext in ['.csv', '.txt']:
-            # Загрузка файла от пользователя в байтовый буфер
-            buffer = BytesIO()
+            # Загрузка файла от пользователя в байтовый буфер с вычислением хеша по мере загрузки
+            buffer = HashingBuffer()
             await message.document.download(destination_file=buffer)
             # Считывание табеля в кодировке cp1251 либо utf8
-            encoded = buffer.read()
-            # Преобразование в кодировку utf8 для обработки
-            content = str(from_bytes(encoded).best())
-            # Преобразование в кодировку cp1251 для отправки
-            encoded = encode_cp1251(content)
+            received = buffer.read()
+            received_sha256 = buffer.hexdigest()
+            metrics.timesheet_bytes.labels('upload').observe(len(received))
+            authorized = org and user['person_rn']
+            # Повторная отправка табеля в cp1251 распознаётся до определения кодировки
+            if authorized:
+                previous = await cache.get_upload_ledger(
+                    org['db_key'], org['org_rn'], received_sha256, config['uploads']['dedup_window'])
+                if previous:
+                    metrics.upload_duplicates.inc()
+                    await message.reply(_duplicate_text(filename, previous), reply_markup=types.ReplyKeyboardRemove())
+                    await state.finish()
+                    return
+            # Преобразование в кодировку cp1251 для отправки и извлечение реквизитов учреждения вне цикла событий
+            try:
+                encoded, charset_path, org_code, org_inn = await executor.run(prepare_timesheet, received)
+            except ValueError as error:
+                await echo_error(message, f'Ошибка чтения табеля: {error}')
+                return
+            # Учитывается в текущем процессе, поскольку декодирование может выполняться в другом процессе
+            metrics.timesheet_charset.labels(charset_path).inc()
+            logging.info(f'Табель {filename}: кодировка определена способом {charset_path}')
             # Проверка авторизации учреждения и пользователя
-            org_code, org_inn = _extract_org_code_inn(content)
-            org = await cache.get_user_org(message.from_user.id)
-            user = await cache.get_user(message.from_user.id)
-            if org and org_code == org['org_code'] and org_inn == org['org_inn'] and user['person_rn']:
+            if authorized and org_code == org['org_code'] and org_inn == org['org_inn']:
+                # Хеш полученного табеля в cp1251 совпадает с хешем табеля для отправки
+                sha256 = received_sha256 if encoded == received else None
                 # Отправка табеля посещаемости в Парус
-                if await send_timesheet(message, state, encoded, filename):
+                if await send_timesheet(message, state, org, encoded, filename, sha256):
                     return
             # Сохранение табеля для загрузки после авторизации
             await state.update_data({'content': encoded, 'filename': filename})
@@ -329,15 +379,91 @@ async def process_timesheet(message: types.Message, state: FSMContext):
             # Авторизация в учреждении с ИНН в табеле
             message.text = org_inn
             await process_inn(message, state)
+        elif file_ext.lower() == '.zip':
+            await process_timesheet_archive(message, user, org)
         else:
             await echo_error(message, 'Файл не содержит табель посещаемости')
 
 
-def _extract_org_code_inn(content):
-    """Извлечение мнемокода и ИНН учреждения из табеля"""
-    lines = content.splitlines()
-    org_fields = lines[1].split(';') if len(lines) >= 2 else None
-    return org_fields[:2] if len(org_fields) >= 2 else None
+async def process_timesheet_archive(message: types.Message, user, org):
+    """
+    Постановка в очередь загрузки в Парус табелей из архива ZIP.
+    Табели распаковываются и подготавливаются параллельно в пуле вычислений, результат загрузки
+    всех табелей архива сообщается одним отчётом
+    """
+    if not (org and user['person_rn']):
+        await echo_error(message, 'Для отправки архива табелей авторизуйтесь командой /start')
+        return
+    buffer = BytesIO()
+    await message.document.download(destination_file=buffer)
+    archive = buffer.getvalue()
+    metrics.timesheet_bytes.labels('archive').observe(len(archive))
+    try:
+        names = list_archive_timesheets(archive, config['archive']['max_entries'])
+    except ValueError as error:
+        await echo_error(message, f'Ошибка чтения архива: {error}')
+        return
+    if not names:
+        await echo_error(message, 'Архив не содержит табели посещаемости')
+        return
+    await message.reply(f'Архив принят, табелей: {len(names)}. Отчёт о загрузке в Парус придёт отдельным сообщением',
+                        reply_markup=types.ReplyKeyboardRemove())
+    # Табели делятся на последовательные части по числу исполнителей пула, чтобы сохранить порядок архива,
+    # архив передаётся в пул один раз на часть
+    size = -(-len(names) // config['executor']['workers'])
+    prepared = await asyncio.gather(*(
+        executor.run(prepare_archive_timesheets, archive, names[start:start + size], config['archive']['max_entry_size'])
+        for start in range(0, len(names), size)))
+    entries = [entry for part in prepared for entry in part]
+    batch_id = await cache.create_upload_batch({
+        'user_id': message.from_user.id,
+        'chat_id': message.chat.id,
+        'message_id': message.message_id,
+        'filename': message.document.file_name,
+        'total': len(entries),
+    })
+    index = 0
+    try:
+        for index, entry in enumerate(entries):
+            await _queue_archive_timesheet(message, org, batch_id, index, entry)
+    except Exception:
+        # Табели, не поставленные в очередь, попадают в отчёт с ошибкой, иначе отчёт не будет отправлен
+        for index, entry in enumerate(entries[index:], index):
+            await cache.save_upload_batch_result(
+                batch_id, index, entry['filename'], False, 'табель не поставлен в очередь загрузки')
+        await uploads.report_batch(batch_id)
+        raise
+    # Отчёт отправляется сразу, если ни один табель архива не поставлен в очередь
+    await uploads.report_batch(batch_id)
+
+
+async def _queue_archive_timesheet(message: types.Message, org, batch_id, index, entry):
+    """Постановка в очередь загрузки табеля архива либо сохранение результата, если табель не загружается"""
+    if 'error' in entry:
+        await cache.save_upload_batch_result(
+            batch_id, index, entry['filename'], False, f'ошибка чтения табеля: {entry["error"]}')
+        return
+    metrics.timesheet_charset.labels(entry['charset_path']).inc()
+    # Загружаются только табели учреждения пользователя
+    if not (entry['org_code'] == org['org_code'] and entry['org_inn'] == org['org_inn']):
+        await cache.save_upload_batch_result(
+            batch_id, index, entry['filename'], False,
+            f'табель другого учреждения {entry["org_code"]} с ИНН {entry["org_inn"]}')
+        return
+    # Табель, уже загруженный в учреждение, повторно не загружается
+    previous = await cache.claim_upload_ledger(
+        org['db_key'], org['org_rn'], entry['sha256'], config['uploads']['dedup_window'])
+    if previous:
+        metrics.upload_duplicates.inc()
+        await cache.save_upload_batch_result(
+            batch_id, index, entry['filename'], previous['result'] is not None,
+            _duplicate_text(entry['filename'], previous))
+        return
+    try:
+        await uploads.put(message, org, entry['content'], entry['filename'], entry['sha256'], batch_id, index)
+    except Exception:
+        await cache.delete_upload_ledger(org['db_key'], org['org_rn'], entry['sha256'])
+        raise
 
 
 async def prompt_to_input_inn(message: types.Message):
@@ -350,13 +476,12 @@ async def prompt_to_input_fio(message: types.Message):
     await message.reply('Ваши Фамилия Имя Отчество?', reply_markup=types.ReplyKeyboardRemove())
 
 
-async def prompt_to_input_group(message: types.Message, state: FSMContext):
+async def prompt_to_input_group(message: types.Message, state: FSMContext, user, org):
     """Приглашение к выбору групп учреждения"""
-    org = await cache.get_user_org(message.from_user.id)
     # Получение списка групп учреждения
     if org:
         try:
-            group_codes = await websrv.get_groups(org['db_key'], org['org_rn'])
+            group_codes = await tsheebot.get_groups(org['db_key'], org['org_rn'])
             # Действующие группы в учреждении не найдены
             if not group_codes:
                 raise Exception('Действующие группы в учреждении не найдены')
@@ -369,7 +494,7 @@ async def prompt_to_input_group(message: types.Message, state: FSMContext):
             await state.finish()
     else:
         # Авторизация
-        await cmd_start(message, state)
+        await cmd_start(message, state, user, org)
 
 
 async def prompt_to_input_org(message: types.Message, orgs):
@@ -378,3 +503,12 @@ async def prompt_to_input_org(message: types.Message, orgs):
     org_codes = [o['org_code'] for o in orgs]
     markup.add(*org_codes)
     await message.reply('Выберите учреждение', reply_markup=markup)
+
+
+@dp.errors_handler(exception=websrv.WebsrvUnavailable)
+async def websrv_unavailable(update: types.Update, error: websrv.WebsrvUnavailable):
+    """Сообщение о недоступности Паруса учреждения; состояние сохраняется для повтора ввода"""
+    logging.warning(f'Парус {error.db_key}: {error.reason}')
+    if update.message:
+        await update.message.reply(str(error), reply_markup=types.ReplyKeyboardRemove())
+    return True
@@ -0,0 +1,81 @@
+import asyncio
+from time import perf_counter
+from aiogram import types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+import app.store.cache.models as cache
+from app.sys import metrics
+
+
+class DrainMiddleware(BaseMiddleware):
+    """
+    Учёт обновлений в обработке для их завершения перед остановкой процесса
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        self.in_flight += 1
+        self._idle.clear()
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        self.in_flight -= 1
+        if not self.in_flight:
+            self._idle.set()
+
+    async def drain(self, timeout) -> int:
+        """
+        Ожидание завершения обработки обновлений не дольше timeout секунд
+        :return: количество незавершённых обновлений
+        """
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.in_flight
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Число обновлений в обработке и длительность обработчиков сообщений.
+    Метка handler - имя функции обработчика
+    """
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        metrics.updates_in_flight.inc()
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        metrics.updates_in_flight.dec()
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        # После вызова обработчика текущий обработчик уже сброшен, поэтому имя запоминается заранее
+        data['handler_started'] = current_handler.get().__name__, perf_counter()
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        if 'handler_started' in data:
+            handler, started = data.pop('handler_started')
+            metrics.handler_seconds.labels(handler).observe(perf_counter() - started)
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """
+    Загрузка пользователя и его учреждения один раз на обновление.
+    Обработчики получают их в параметрах user и org
+    """
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        data['unit_of_work'] = await cache.open_unit_of_work()
+        try:
+            data['user'], data['org'] = await cache.get_user_context(message.from_user.id)
+        except Exception:
+            # При ошибке обработчик и on_post_process_message не вызываются, поэтому сессия закрывается здесь
+            await cache.close_unit_of_work(*data.pop('unit_of_work'))
+            raise
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        if 'unit_of_work' in data:
+            await cache.close_unit_of_work(*data.pop('unit_of_work'))
@@ -1,7 +1,36 @@
 from typing import Optional
 import app.store.cache.models as cache
 import app.store.websrv.models as websrv
-from tools.helpers import keys_exists
+from app.settings import config
+from tools.helpers import normalize_fio, split_fio
+from tools.singleflight import SingleFlight
+from tools.ttl_cache import TTLCache
+
+# Обновление учреждений по ИНН из веб-сервиса: не чаще одного раза за интервал и одно на ИНН.
+# ИНН, обновлённые в течение интервала, хранятся в кэше со временем жизни, равным интервалу
+orgs_refresh = SingleFlight('Обновление учреждений')
+_orgs_refreshed = TTLCache(config['websrv']['orgs_refresh_cache_size'], config['websrv']['orgs_refresh_interval'])
+# Списки групп учреждений по ключу (db_key, org_rn)
+groups_cache = TTLCache(config['websrv']['groups_cache_size'], config['websrv']['groups_ttl'])
+groups_fetch = SingleFlight('Получение групп')
+# Табели групп (содержимое, имя файла) по ключу (db_key, org_rn, поколение, группа).
+# Загрузка табеля в учреждение увеличивает поколение, и прежние табели учреждения становятся недоступны
+timesheets_cache = TTLCache(config['websrv']['timesheet_cache_size'], config['websrv']['timesheet_ttl'])
+timesheets_fetch = SingleFlight('Получение табеля')
+_timesheets_generation = {}
+
+
+async def _refresh_orgs(org_inn) -> list[dict]:
+    """Поиск учреждений по ИНН в веб-сервисе с кэшированием; после сбоя обновление повторяется при следующем поиске"""
+    orgs = await cache.upsert_orgs(await websrv.get_orgs(org_inn))
+    _orgs_refreshed.set(org_inn, True)
+    return orgs
+
+
+def _schedule_orgs_refresh(org_inn):
+    """Фоновое обновление учреждений по ИНН, если истёк интервал обновления"""
+    if not _orgs_refreshed.get(org_inn):
+        orgs_refresh.start(org_inn, _refresh_orgs, org_inn)
 
 
 async def get_orgs(org_inn) -> list[dict]:
@@ -10,21 +39,12 @@ async def get_orgs(org_inn) -> list[dict]:
     orgs = await cache.get_orgs(org_inn)
     # В кэше нет учреждений с таким ИНН
     if len(orgs) == 0:
-        # Поиск учреждений по ИНН в веб-сервисе
-        orgs = await websrv.get_orgs(org_inn)
-        # Кэширование учреждений
-        await cache.insert_orgs(orgs)
-    # В кеше одно учреждение с таким ИНН
-    elif len(orgs) == 1:
-        # Поиск учреждений по ИНН в веб-сервисе на случай добавления учреждения в базе данных веб-сервиса
-        orgs = await websrv.get_orgs(org_inn)
-        # Кеширование нового учреждения (существующее учреждение добавлено не будет)
-        if len(orgs) == 2:
-            await cache.insert_orgs(orgs)
-    for o in orgs:
-        if not keys_exists(['id'], o):
-            org = await get_org(o['org_code'], o['org_inn'])
-            o.update({'id': org['id']})
+        # Поиск учреждений по ИНН в веб-сервисе с ожиданием результата
+        orgs = await orgs_refresh.do(org_inn, _refresh_orgs, org_inn)
+    else:
+        # Учреждения из кэша возвращаются сразу, а добавленные в базе данных веб-сервиса
+        # учреждения появятся в кэше после фонового обновления
+        _schedule_orgs_refresh(org_inn)
     return orgs
 
 
@@ -42,3 +62,84 @@ async def get_org(org_code, org_inn) -> Optional[dict]:
                 org = o
                 break
     return org
+
+
+async def _fetch_groups(db_key, org_rn) -> list[str]:
+    """Получение списка групп учреждения из SQLite либо из веб-сервиса с сохранением"""
+    if config['websrv']['groups_persist']:
+        groups = await cache.get_groups(db_key, org_rn, config['websrv']['groups_ttl'])
+        if groups:
+            return groups
+    groups = await websrv.get_groups(db_key, org_rn)
+    if groups and config['websrv']['groups_persist']:
+        await cache.save_groups(db_key, org_rn, groups)
+    return groups
+
+
+async def get_groups(db_key, org_rn) -> list[str]:
+    """Получение списка групп учреждения из кэша либо из веб-сервиса с кэшированием"""
+    key = (db_key, org_rn)
+    groups = groups_cache.get(key)
+    if groups is None:
+        # Одновременные промахи по одному учреждению ожидают один запрос
+        groups = await groups_fetch.do(key, _fetch_groups, db_key, org_rn)
+        # Пустой список не кэшируется: группы могут появиться либо веб-сервис был недоступен
+        if groups:
+            groups_cache.set(key, groups)
+    return list(groups)
+
+
+async def invalidate_groups(db_key, org_rn):
+    """Удаление списка групп учреждения из кэша"""
+    groups_cache.pop((db_key, org_rn))
+    if config['websrv']['groups_persist']:
+        await cache.delete_groups(db_key, org_rn)
+
+
+async def get_person(db_key, org_rn, family, firstname, lastname) -> Optional[int]:
+    """
+    Поиск сотрудника учреждения по ФИО в кэше либо в веб-сервисе с кэшированием.
+    Найденный сотрудник хранится долго, отрицательный результат - недолго, чтобы повторные попытки
+    с ошибкой в ФИО не нагружали Парус. Сбой Паруса не кэшируется
+    """
+    # Парусу отправляются ФИО без лишних пробелов
+    family, firstname, lastname = split_fio(' '.join(part for part in (family, firstname, lastname) if part))
+    fio = normalize_fio(family, firstname, lastname)
+    query = ' '.join(part for part in (family, firstname, lastname) if part)
+    found, person_rn = await cache.get_person(
+        db_key, org_rn, fio, query, config['websrv']['person_ttl'], config['websrv']['person_negative_ttl'])
+    if not found:
+        person_rn = await websrv.get_person(db_key, org_rn, family, firstname, lastname)
+        await cache.save_person(db_key, org_rn, fio if person_rn else query, person_rn)
+    return person_rn
+
+
+def _timesheet_key(db_key, org_rn, group):
+    return db_key, org_rn, _timesheets_generation.get((db_key, org_rn), 0), group
+
+
+def invalidate_timesheets(db_key, org_rn):
+    """Удаление табелей групп учреждения из кэша"""
+    _timesheets_generation[(db_key, org_rn)] = _timesheets_generation.get((db_key, org_rn), 0) + 1
+
+
+async def receive_timesheet(db_key, org_rn, group):
+    """Получение табеля посещаемости группы из кэша либо из веб-сервиса с кэшированием"""
+    key = _timesheet_key(db_key, org_rn, group)
+    cached = timesheets_cache.get(key)
+    if cached:
+        content, filename = cached
+        return content, filename, 200, 'OK'
+    # Одновременные запросы табеля одной группы ожидают одно получение из веб-сервиса
+    content, filename, status, reason = await timesheets_fetch.do(
+        key, websrv.receive_timesheet, db_key, org_rn, group)
+    if status == 200:
+        timesheets_cache.set(key, (content, filename))
+    return content, filename, status, reason
+
+
+async def send_timesheet(org, content, filename):
+    """Отправка табеля посещаемости в Парус с удалением табелей учреждения из кэша"""
+    result = await websrv.send_timesheet(org['db_key'], org['company_rn'], content, filename)
+    invalidate_timesheets(org['db_key'], org['org_rn'])
+    return result
@@ -0,0 +1,101 @@
+"""
+Бот с очередью исходящих запросов к Telegram Bot API
+с общим ограничением частоты, ограничением частоты в каждом чате и приоритетом текстовых сообщений
+"""
+
+import io
+import logging
+from time import monotonic, perf_counter
+from aiogram import Bot
+from aiogram.types import InputFile
+from aiogram.utils.exceptions import RetryAfter
+from app.settings import config
+from app.sys import metrics
+from tools.rate_limit import TokenBucket, PriorityLimiter
+from tools.ttl_cache import TTLCache
+
+# Приоритеты запросов: текстовые ответы обслуживаются раньше отправки файлов
+PRIORITY_TEXT = 0
+PRIORITY_FILE = 1
+
+# Методы, отправляющие сообщения в чат и подпадающие под ограничения Telegram
+LIMITED_METHODS = frozenset((
+    'sendMessage', 'sendDocument', 'sendPhoto', 'sendMediaGroup', 'sendChatAction',
+    'editMessageText', 'editMessageReplyMarkup', 'forwardMessage', 'copyMessage',
+))
+FILE_METHODS = frozenset(('sendDocument', 'sendPhoto', 'sendMediaGroup'))
+
+
+def _file_contents(files) -> dict:
+    """
+    Содержимое файлов запроса для повторной отправки: aiohttp закрывает файл после первой попытки
+    :return: {ключ: (имя файла, байты либо None, если файл нельзя прочитать заново)}
+    """
+    contents = {}
+    for key, file in (files or {}).items():
+        source = file.file if isinstance(file, InputFile) else None
+        if isinstance(source, io.IOBase) and not source.closed and source.seekable():
+            position = source.tell()
+            contents[key] = file.filename, source.read()
+            source.seek(position)
+        else:
+            contents[key] = None, None
+    return contents
+
+
+class ThrottledBot(Bot):
+    """
+    Запросы, отправляющие сообщения, ожидают токен корзины чата и затем токен общей корзины.
+    Ответ 429 приостанавливает отправку в чат на указанное Telegram время, после чего запрос повторяется
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        sender = config['sender']
+        # Общее ограничение Telegram действует на бота, поэтому делится между рабочими процессами
+        workers = max(config['bot']['workers'], 1)
+        self.limiter = PriorityLimiter(sender['rate'] / workers, max(sender['burst'] // workers, 1))
+        # Корзина чата, не использовавшаяся дольше времени заполнения, полна и может быть создана заново
+        self.chat_buckets = TTLCache(sender['chats_cache_size'], sender['chat_burst'] / sender['chat_rate'])
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(config['sender']['chat_rate'], config['sender']['chat_burst'])
+        self._keep_chat_bucket(chat_id, bucket)
+        return bucket
+
+    def _keep_chat_bucket(self, chat_id, bucket):
+        """
+        Время жизни корзины отсчитывается от последнего использования, а у приостановленной корзины -
+        от окончания паузы, чтобы вместо неё не была создана полная корзина
+        """
+        paused = max(bucket.paused_until - monotonic(), 0)
+        self.chat_buckets.set(chat_id, bucket, self.chat_buckets.ttl + paused)
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        if method not in LIMITED_METHODS:
+            return await super().request(method, data, files, **kwargs)
+        chat_id = data.get('chat_id') if data else None
+        priority = PRIORITY_FILE if method in FILE_METHODS or files else PRIORITY_TEXT
+        contents = _file_contents(files)
+        for attempt in range(config['sender']['retries'] + 1):
+            if attempt:
+                # Повторная попытка отправляет новые файлы с прежним содержимым
+                files = {key: InputFile(io.BytesIO(content), filename)
+                         for key, (filename, content) in contents.items()}
+            started = perf_counter()
+            bucket = self._chat_bucket(chat_id)
+            await bucket.acquire()
+            await self.limiter.acquire(priority)
+            metrics.send_wait_seconds.labels(priority).observe(perf_counter() - started)
+            try:
+                return await super().request(method, data, files, **kwargs)
+            except RetryAfter as error:
+                metrics.send_retry_after.inc()
+                logging.warning(f'Telegram {method} чат {chat_id}: повтор через {error.timeout} с')
+                bucket.pause(error.timeout)
+                self._keep_chat_bucket(chat_id, bucket)
+                if attempt == config['sender']['retries'] or any(
+                        content is None for _, content in contents.values()):
+                    raise
@@ -0,0 +1,200 @@
+"""
+Очередь загрузки табелей в Парус, хранящаяся в кэше SQLite.
+Обработчик сообщения ставит табель в очередь и сразу отвечает пользователю,
+исполнители загружают табели в Парус и присылают пользователю результат загрузки
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+from time import time
+from aiogram import Bot, types
+import app.store.cache.models as cache
+import app.store.websrv.models as websrv
+import app.tsheebot.models as tsheebot
+from app.settings import config
+from app.sys import metrics
+
+
+class UploadQueue:
+    """
+    Исполнители берут задания в аренду, поэтому очередь разделяется рабочими процессами.
+    Задания пользователя выполняются по порядку, одновременно в одной базе данных Паруса
+    выполняется не больше uploads.db_key_concurrency заданий.
+    Задание, отклонённое до отправки в Парус (выключатель, переполнение), откладывается и повторяется.
+    Задание, прерванное остановкой процесса, повторяется после истечения аренды, а если табель уже
+    отправлялся в Парус, пользователю сообщается, что результат загрузки неизвестен
+    """
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self._workers = []
+        self._purger = None
+        self._wakeup = None
+        self._stopping = False
+
+    async def on_connect(self):
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        await self._recover()
+        # Исполнители общие для всех обновлений, поэтому выполняются в пустом контексте
+        self._workers = [
+            contextvars.Context().run(asyncio.ensure_future, self._work(f'{os.getpid()}-{index}'))
+            for index in range(config['uploads']['workers'])]
+        self._purger = contextvars.Context().run(asyncio.ensure_future, self._purge_forever())
+
+    async def on_disconnect(self):
+        """Остановка исполнителей с ожиданием текущих загрузок не дольше uploads.shutdown_timeout"""
+        self._stopping = True
+        self._wakeup.set()
+        if self._purger:
+            self._purger.cancel()
+            await asyncio.gather(self._purger, return_exceptions=True)
+            self._purger = None
+        if self._workers:
+            _, pending = await asyncio.wait(self._workers, timeout=config['uploads']['shutdown_timeout'])
+            for worker in pending:
+                worker.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        self._workers = []
+
+    async def put(self, message: types.Message, org, content, filename, sha256=None,
+                  batch_id=None, batch_index=None) -> int:
+        """
+        Постановка табеля в очередь загрузки
+        :param sha256: хеш табеля в журнале загруженных табелей, в который записывается результат загрузки
+        :param batch_id: номер архива, результат загрузки табеля войдёт в отчёт по архиву
+        :param batch_index: номер табеля в архиве
+        :return: номер задания
+        """
+        job_id = await cache.enqueue_upload({
+            'user_id': message.from_user.id,
+            'chat_id': message.chat.id,
+            'message_id': message.message_id,
+            'db_key': org['db_key'],
+            'org_rn': org['org_rn'],
+            'company_rn': org['company_rn'],
+            'filename': filename,
+            'content': content,
+            'sha256': sha256,
+            'batch_id': batch_id,
+            'batch_index': batch_index,
+        })
+        if self._wakeup:
+            self._wakeup.set()
+        return job_id
+
+    async def _work(self, worker):
+        while not self._stopping:
+            # Ошибка кэша SQLite (например, база заблокирована) не завершает исполнителя
+            try:
+                job = await cache.claim_upload(
+                    worker, config['uploads']['lease'], config['uploads']['db_key_concurrency'])
+                if job is None:
+                    await self._wait()
+                    continue
+                await self._run(job)
+                # Завершение задания могло сделать доступными следующие задания пользователя или базы данных
+                self._wakeup.set()
+            except Exception as error:
+                logging.exception(f'Очередь загрузки табелей: {error!r}')
+                await asyncio.sleep(config['uploads']['poll_interval'])
+
+    async def _wait(self):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), config['uploads']['poll_interval'])
+            self._wakeup.clear()
+        except asyncio.TimeoutError:
+            # Задания других процессов, остановленных во время загрузки
+            await self._recover()
+
+    async def _purge_forever(self):
+        """Периодическое удаление устаревших записей журнала загруженных табелей и архивов, начиная с запуска"""
+        while True:
+            try:
+                await cache.purge_upload_ledger(config['uploads']['dedup_window'])
+                # Архив, отчёт по которому не отправлен за это время, уже не завершится
+                await cache.purge_upload_batches(config['uploads']['dedup_window'])
+            except Exception as error:
+                logging.error(f'Ошибка очистки журнала загруженных табелей: {error!r}')
+            await asyncio.sleep(config['uploads']['purge_interval'])
+
+    async def _recover(self):
+        """Возврат в очередь заданий с истёкшей арендой и завершение заданий, прерванных во время отправки"""
+        requeued = await cache.requeue_expired_uploads()
+        if requeued:
+            logging.info(f'Возвращено в очередь загрузки табелей: {requeued}')
+        for job in await cache.take_lost_uploads():
+            logging.warning(f'Загрузка табеля {job["filename"]} прервана во время отправки в Парус')
+            if job['sha256']:
+                await cache.delete_upload_ledger(job['db_key'], job['org_rn'], job['sha256'])
+            metrics.upload_jobs.labels('unknown').inc()
+            await self._report(job, False, f'Загрузка табеля {job["filename"]} в Парус прервана, '
+                                           f'результат неизвестен. Проверьте табель в Парусе перед повторной отправкой')
+
+    async def _run(self, job):
+        org = {'db_key': job['db_key'], 'org_rn': job['org_rn'], 'company_rn': job['company_rn']}
+        await cache.mark_upload_sending(job['id'])
+        try:
+            result = await tsheebot.send_timesheet(org, job['content'], job['filename'])
+            outcome = 'done'
+        except websrv.WebsrvUnavailable as error:
+            if not error.sent and job['attempts'] < config['uploads']['max_attempts']:
+                logging.warning(f'Загрузка табеля {job["filename"]} отложена: {error.reason}')
+                metrics.upload_jobs.labels('deferred').inc()
+                await cache.defer_upload(job['id'], config['uploads']['retry_delay'])
+                return
+            result = f'Ошибка загрузки табеля {job["filename"]} в Парус: {error}'
+            outcome = 'failed'
+        except Exception as error:
+            logging.exception(f'Загрузка табеля {job["filename"]}')
+            result = f'Ошибка загрузки табеля {job["filename"]} в Парус: {error}'
+            outcome = 'failed'
+        await cache.delete_upload(job['id'])
+        if job['sha256']:
+            # Табель, не загруженный из-за ошибки, можно отправить повторно
+            if outcome == 'done':
+                await cache.save_upload_result(job['db_key'], job['org_rn'], job['sha256'], result)
+            else:
+                await cache.delete_upload_ledger(job['db_key'], job['org_rn'], job['sha256'])
+        metrics.upload_jobs.labels(outcome).inc()
+        metrics.upload_wait_seconds.observe(time() - job['created_at'])
+        await self._report(job, outcome == 'done', result)
+
+    async def _report(self, job, success, text):
+        """Сообщение о результате загрузки табеля либо его сохранение для отчёта по архиву"""
+        if job['batch_id'] is None:
+            await self._reply(job, text)
+            return
+        await cache.save_upload_batch_result(job['batch_id'], job['batch_index'], job['filename'], success, text)
+        await self.report_batch(job['batch_id'])
+
+    async def report_batch(self, batch_id):
+        """Отправка отчёта по архиву, если получены результаты всех его табелей"""
+        complete = await cache.take_complete_upload_batch(batch_id)
+        if complete:
+            batch, results = complete
+            await self._reply(batch, archive_report(batch['filename'], results))
+
+    async def _reply(self, job, text):
+        """Сообщение пользователю о результате загрузки в ответ на сообщение с табелем или архивом"""
+        try:
+            await self.bot.send_message(
+                job['chat_id'], text,
+                reply_to_message_id=job['message_id'], allow_sending_without_reply=True)
+        except Exception as error:
+            logging.error(f'Результат загрузки табеля {job["filename"]} не отправлен: {error!r}')
+
+
+def archive_report(archive_name, results) -> str:
+    """
+    Отчёт о загрузке табелей архива в пределах длины сообщения Telegram
+    :param results: результаты табелей архива: filename, success, text
+    """
+    loaded = sum(1 for result in results if result['success'])
+    lines = [f'Архив {archive_name}: загружено табелей {loaded} из {len(results)}']
+    for result in results:
+        lines.append(f'{"+" if result["success"] else "-"} {result["filename"]}: {result["text"][:200]}')
+    report = '\n'.join(lines)
+    return report if len(report) <= 4096 else report[:4093] + '...'
@@ -2,62 +2,119 @@
 Телеграм бот взаимодействия мобильного приложения "Табели посещаемости" с учётной системой "Парус"
 на основе асинхронной библиотеки aiogram
 """
+import asyncio
 import logging
 import os
 import signal
+import socket
 import sys
 
+from aiohttp import web
 from aiogram import Dispatcher
 from app.settings import config, BASE_DIR
+import app.store.cache.models as cache_models
 from app.store.cache.models import db as cache
-from app.tsheebot.bot import bot, dp
+from app.store.cache.fsm_storage import SqliteStorage
+from app.store.websrv.models import client as websrv
+from app.tsheebot.bot import bot, dp, uploads, updates
+from app.sys.executor import executor
+from app.sys import metrics
 from app.sys.pid_file import read_pid_file, write_pid_file, remove_pid_file
+from app.sys.workers import supervise
 
 
 logging.basicConfig(
     filename=config['log_file'] if config['use_log_file'] else None,
     level=logging.INFO)
 
+# Номер рабочего процесса при запуске нескольких процессов, None - единственный процесс
+worker_index = None
+# Прежний процесс, работу которого принимает новый процесс при перезапуске, None - обычный запуск
+previous_pid = None
+# Процесс передаёт работу новому процессу и не снимает вебхук при остановке
+handing_over = False
+
+
+def is_primary():
+    """Вебхук устанавливается и снимается только одним процессом"""
+    return worker_index in (None, 0)
+
+
+def hand_over():
+    """Остановка по сигналу нового процесса без снятия вебхука"""
+    global handing_over
+    logging.info(f'Передача работы новому процессу')
+    handing_over = True
+    raise web.GracefulExit()
+
 
 async def on_startup(_: Dispatcher):
     logging.info(f'Подключение кэша')
     await cache.on_connect()
-    logging.info(f'Подключение вебхука')
-    from aiogram.types.input_file import InputFile
-    from pathlib import Path
-    await bot.set_webhook(
-       f'{config["webhook"]["url"]}/bot{config["bot_token"]}',
-       certificate=InputFile(Path(os.path.join(BASE_DIR, config['webhook']['cert_path']))),
-       drop_pending_updates=True)
-    if config['use_pid_file']:
+    if isinstance(dp.storage, SqliteStorage):
+        dp.storage.start_sweeper()
+    logging.info(f'Подключение веб-сервиса')
+    await websrv.on_connect()
+    logging.info(f'Запуск пула вычислений')
+    await executor.on_connect()
+    logging.info(f'Запуск очереди загрузки табелей')
+    await uploads.on_connect()
+    if is_primary():
+        logging.info(f'Подключение вебхука')
+        from aiogram.types.input_file import InputFile
+        from pathlib import Path
+        # При перезапуске обновления, накопленные в Телеграм, получает новый процесс
+        await bot.set_webhook(
+           f'{config["webhook"]["url"]}/bot{config["bot_token"]}',
+           certificate=InputFile(Path(os.path.join(BASE_DIR, config['webhook']['cert_path']))),
+           drop_pending_updates=previous_pid is None)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, hand_over)
+    if config['use_pid_file'] and worker_index is None:
         pid_from_os = write_pid_file()
         pid_info = f' pid={pid_from_os}'
     else:
         pid_info = ''
     logging.info(f'tsheebot запущен{pid_info}')
+    if previous_pid and is_primary():
+        # Сокет нового процесса уже принимает соединения, прежний процесс завершает обработку и останавливается
+        logging.info(f'Передача работы от процесса pid={previous_pid}')
+        stop(previous_pid, signal.SIGUSR2)
 
 
 async def on_shutdown(_: Dispatcher):
-    logging.info(f'Отключение вебхука')
-    await bot.set_webhook('')
+    # Сокет уже закрыт, поэтому новые обновления не поступают, кроме уже открытых соединений
+    logging.info(f'Завершение обработки обновлений: {updates.in_flight}')
+    in_flight = await updates.drain(config['bot']['drain_timeout'])
+    if in_flight:
+        logging.warning(f'Не завершена обработка обновлений: {in_flight}, Телеграм отправит их повторно')
+    if is_primary() and not handing_over:
+        logging.info(f'Отключение вебхука')
+        await bot.set_webhook('')
+    logging.info(f'Остановка очереди загрузки табелей')
+    await uploads.on_disconnect()
+    logging.info(f'Отключение веб-сервиса')
+    await websrv.on_disconnect()
+    logging.info(f'Остановка пула вычислений')
+    await executor.on_disconnect()
     logging.info(f'Отключение кэша')
     await cache.on_disconnect()
-    if config['pid_file']:
-        pid_from_file = remove_pid_file()
-        pid_info = f' pid={pid_from_file}'
+    if config['pid_file'] and worker_index is None:
+        remove_pid_file()
+        pid_info = f' pid={os.getpid()}'
     else:
         pid_info = ''
     logging.info(f'tsheebot остановлен{pid_info}')
 
 
-def stop(pid):
+def stop(pid, signum=signal.SIGINT):
     try:
-        os.kill(pid, signal.SIGINT)
+        os.kill(pid, signum)
     except ProcessLookupError:
         logging.error(f'Процесс с pid={pid} не найден')
 
 
 def run(command):
+    global previous_pid
     pid_from_file = read_pid_file()
     if command == 'start':
         if pid_from_file:
@@ -66,26 +123,82 @@ def run(command):
         stop(pid_from_file)
         exit()
     elif command == 'restart':
-        if pid_from_file:
-            stop(pid_from_file)
+        # Прежний процесс останавливается новым процессом после его запуска
+        previous_pid = pid_from_file
     else:
         logging.warning(f'Использование: tsheebot/main.py [start|stop|restart]')
 
 
+def bind_socket():
+    """
+    Сокет сервера вебхука, разделяющий порт через SO_REUSEPORT с рабочими процессами
+    и с прежним процессом при перезапуске
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((config['bot']['host'], config['bot']['port']))
+    sock.listen(socket.SOMAXCONN)
+    return sock
+
+
+def start_server(index=None):
+    """
+    Запуск сервера вебхука
+    :param index: номер рабочего процесса, разделяющего порт с остальными через SO_REUSEPORT
+    """
+    global worker_index
+    worker_index = index
+    from aiogram.utils.executor import set_webhook
+    web_app = web.Application()
+    if config['metrics']['enabled']:
+        # Метрики отдаются тем же сервером, что и вебхук; при нескольких процессах - метрики ответившего процесса
+        web_app.router.add_get(config['metrics']['path'], metrics.metrics_handler)
+    webhook = set_webhook(
+        dispatcher=dp,
+        webhook_path=f'/bot{config["bot_token"]}',
+        skip_updates=is_primary() and previous_pid is None,
+        on_startup=on_startup,
+        on_shutdown=on_shutdown,
+        web_app=web_app,
+    )
+    # Сокет принимает соединения до запуска, чтобы при перезапуске прежний процесс остановился после этого
+    webhook.run_app(sock=bind_socket())
+
+
+async def prepare_cache():
+    """Создание схемы кэша до запуска рабочих процессов"""
+    await cache.on_connect()
+    await cache.on_disconnect()
+
+
+def start_workers(workers):
+    """Запуск нескольких рабочих процессов под управлением текущего процесса"""
+    if not isinstance(dp.storage, SqliteStorage):
+        raise RuntimeError('Для нескольких рабочих процессов требуется fsm.storage: sqlite')
+    # Пользователи и состояния изменяются разными процессами, поэтому их кэши в памяти отключаются
+    for process_cache in (cache_models.users, cache_models.user_orgs, dp.storage.states):
+        process_cache.maxsize = 0
+    # Цикл событий не устанавливается текущим, чтобы рабочие процессы создали собственные
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(prepare_cache())
+    loop.close()
+    if config['use_pid_file']:
+        logging.info(f'tsheebot запущен pid={write_pid_file()} рабочих процессов: {workers}')
+    supervise(workers, start_server)
+    if config['use_pid_file']:
+        remove_pid_file()
+        logging.info(f'tsheebot остановлен pid={os.getpid()}')
+
+
 if __name__ == '__main__':
     if config['pid_file'] and len(sys.argv) == 2:
         run(sys.argv[1])
     try:
-        from aiogram.utils.executor import start_webhook
-        start_webhook(
-            dispatcher=dp,
-            webhook_path=f'/bot{config["bot_token"]}',
-            skip_updates=True,
-            host=config['bot']['host'],
-            port=config['bot']['port'],
-            on_startup=on_startup,
-            on_shutdown=on_shutdown,
-        )
+        if config['bot']['workers'] > 1:
+            start_workers(config['bot']['workers'])
+        else:
+            start_server()
     except Exception as exception:
         if config['pid_file']:
             remove_pid_file()
@@ -0,0 +1,85 @@
+"""
+Замер запросов кэша SQLite на 100 тыс. пользователей:
+прагмы SQLite по умолчанию без индексов, настроенный профиль соединения без индексов
+и настроенный профиль с индексами миграции версии 2
+Запуск: python -m test.bench_cache [количество пользователей]
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from app.settings import config
+import app.store.cache.models as cache
+from app.store.cache.accessor import Org, User
+
+ORGS_PER_INN = 3
+USERS_PER_ORG = 20
+LOOKUPS = 2000
+
+
+async def fill(users):
+    orgs = users // USERS_PER_ORG
+    async with cache.db.engine.begin() as conn:
+        await conn.execute(Org.__table__.insert(), [
+            dict(id=i + 1, org_rn=i, org_code=f'DS{i % ORGS_PER_INN}', org_name=f'Детский сад {i}',
+                 org_inn=f'{i // ORGS_PER_INN:010d}', company_rn=1, db_key='k')
+            for i in range(orgs)])
+        await conn.execute(User.__table__.insert(), [
+            dict(user_id=i, org_inn=f'{(i % orgs) // ORGS_PER_INN:010d}', org_id=i % orgs + 1,
+                 person_rn=i, family='Иванова', firstname='Мария', lastname='Петровна', group='Ёжики')
+            for i in range(users)])
+
+
+async def measure(users):
+    orgs = users // USERS_PER_ORG
+    queries = {
+        'get_orgs': lambda i: cache.get_orgs(f'{i % orgs // ORGS_PER_INN:010d}'),
+        'get_org': lambda i: cache.get_org(f'DS{i % ORGS_PER_INN}', f'{i % orgs // ORGS_PER_INN:010d}'),
+        'get_user': lambda i: cache.get_user(i * 7919 % users),
+        'get_user_org': lambda i: cache.get_user_org(i * 7919 % users),
+        'get_user_context': lambda i: cache.get_user_context(i * 7919 % users),
+        'update_user': lambda i: cache.update_user({'user_id': i * 7919 % users, 'group': f'Группа {i}'}),
+    }
+    timings = {}
+    for name, query in queries.items():
+        start = time.perf_counter()
+        for i in range(LOOKUPS):
+            await query(i)
+        timings[name] = (time.perf_counter() - start) / LOOKUPS * 1e6
+    return timings
+
+
+async def run(directory, users, pragmas, indexes):
+    config['sqlite']['database'] = os.path.join(directory, f'bench-{len(pragmas)}-{indexes}.db')
+    config['sqlite']['pragmas'] = pragmas
+    await cache.db.on_connect()
+    await fill(users)
+    async with cache.db.engine.begin() as conn:
+        for index in (*Org.__table__.indexes, *User.__table__.indexes):
+            await conn.run_sync(index.create if indexes else index.drop, checkfirst=True)
+        await conn.exec_driver_sql('ANALYZE')
+    timings = await measure(users)
+    await cache.db.on_disconnect()
+    return timings
+
+
+async def main(users):
+    # Кэши в памяти отключаются, чтобы каждый вызов выполнял запрос к SQLite
+    cache.users.maxsize = cache.user_orgs.maxsize = 0
+    tuned = dict(config['sqlite']['pragmas'])
+    with tempfile.TemporaryDirectory() as directory:
+        results = [
+            ('по умолчанию', await run(directory, users, {}, False)),
+            ('профиль', await run(directory, users, tuned, False)),
+            ('профиль+индексы', await run(directory, users, tuned, True)),
+        ]
+    print(f'Пользователей: {users}, учреждений: {users // USERS_PER_ORG}, запросов: {LOOKUPS}, мкс на запрос')
+    print(f'{"запрос":<18}' + ''.join(f'{title:>18}' for title, _ in results))
+    for name in results[0][1]:
+        print(f'{name:<18}' + ''.join(f'{timings[name]:>18.0f}' for _, timings in results))
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000))
@@ -0,0 +1,49 @@
+"""
+Замер подготовки табеля к отправке в Парус:
+прежнее извлечение учреждения разбиением всего текста на строки и чтение заголовка из потока
+Запуск: python -m test.bench_timesheet [количество групп]
+"""
+
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+from tools.cp1251 import encode_cp1251, decode_cp1251
+from tools.timesheet_parser import read_header
+from test.test import make_timesheet
+
+PERSONS_PER_GROUP = 30
+REPEATS = 20
+
+
+def split_lines(cp1251_bytes):
+    content = decode_cp1251(cp1251_bytes)
+    return content.splitlines()[1].split(';')[:2]
+
+
+def measure(function, cp1251_bytes):
+    tracemalloc.start()
+    function(cp1251_bytes)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        function(cp1251_bytes)
+    return (time.perf_counter() - start) / REPEATS * 1e3, peak / 2 ** 20
+
+
+def main(groups):
+    cp1251_bytes = bytes(encode_cp1251(make_timesheet(groups, PERSONS_PER_GROUP)))
+    methods = {
+        'разбиение строк': split_lines,
+        'заголовок': lambda data: read_header(BytesIO(data)),
+    }
+    print(f'Групп: {groups}, сотрудников: {groups * PERSONS_PER_GROUP}, размер: {len(cp1251_bytes) / 2 ** 20:.1f} МБ')
+    print(f'{"способ":<18}{"мс":>10}{"МБ/с":>10}{"пик МБ":>10}')
+    for name, function in methods.items():
+        ms, peak = measure(function, cp1251_bytes)
+        print(f'{name:<18}{ms:>10.1f}{len(cp1251_bytes) / 2 ** 20 / ms * 1e3:>10.0f}{peak:>10.1f}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,4 @@
+"""
+Нагрузочное тестирование бота с локальными заглушками веб-сервиса Паруса и Telegram Bot API
+Запуск: python -m test.load.driver --help
+"""
@@ -0,0 +1,166 @@
+"""
+Нагрузочный прогон бота: синтетические обновления вебхука передаются диспетчеру,
+веб-сервис Паруса и Telegram Bot API заменяются локальными заглушками.
+Каждый пользователь проходит /start -> ИНН -> ФИО -> группа с получением табеля,
+затем присылает табель и повторно получает табель командой /start.
+Обновления одного пользователя обрабатываются последовательно, пользователи - параллельно.
+Запуск: python -m test.load.driver [--users 200] [--concurrency 50] [--latency 0.02]
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+from itertools import count
+from statistics import quantiles
+from time import perf_counter, time
+from aiohttp import web
+from app.settings import config
+from test.load.parus import ParusStub, GROUPS, org_inn
+from test.load.telegram import TelegramStub
+
+STEPS = ('start', 'inn', 'fio', 'group', 'upload', 'download')
+
+
+async def serve(app) -> tuple[web.AppRunner, str]:
+    """Запуск приложения на свободном порту"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f'http://127.0.0.1:{port}'
+
+
+def percentiles(latencies) -> tuple[float, float, float]:
+    """p50, p95, p99 в миллисекундах"""
+    if len(latencies) < 2:
+        return (latencies[0] * 1000,) * 3 if latencies else (0.0,) * 3
+    cuts = quantiles(latencies, n=100, method='inclusive')
+    return cuts[49] * 1000, cuts[94] * 1000, cuts[98] * 1000
+
+
+class Driver:
+    """Формирование обновлений и замер их обработки диспетчером"""
+
+    def __init__(self, dp, orgs):
+        self.dp = dp
+        self.orgs = orgs
+        self.update_ids = count(1)
+        self.latencies = {step: [] for step in STEPS}
+
+    def update(self, user_id, **content):
+        update_id = next(self.update_ids)
+        from aiogram import types
+        return types.Update(**{'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': int(time()), **content,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'Пользователь {user_id}'}}})
+
+    async def send(self, step, update):
+        started = perf_counter()
+        # Каждое обновление обрабатывается в отдельной задаче, как при приёме вебхука
+        await asyncio.create_task(self.dp.process_update(update))
+        self.latencies[step].append(perf_counter() - started)
+
+    async def user_flow(self, user_id):
+        org_index = user_id % self.orgs
+        await self.send('start', self.update(user_id, text='/start'))
+        await self.send('inn', self.update(user_id, text=org_inn(org_index)))
+        await self.send('fio', self.update(user_id, text='Иванова Мария Петровна'))
+        await self.send('group', self.update(user_id, text=GROUPS[user_id % len(GROUPS)]))
+        await self.send('upload', self.update(user_id, document={
+            'file_id': f'ts-{org_index}-{user_id}', 'file_unique_id': f'ts-{org_index}-{user_id}',
+            'file_name': 'timesheet.csv'}))
+        await self.send('download', self.update(user_id, text='/start'))
+
+    async def run(self, users, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(user_id):
+            async with semaphore:
+                await self.user_flow(user_id)
+
+        started = perf_counter()
+        await asyncio.gather(*(limited(user_id) for user_id in range(1, users + 1)))
+        return perf_counter() - started
+
+
+async def main(args):
+    parus = ParusStub(args.orgs, args.latency, args.timesheet_size)
+    telegram = TelegramStub(args.telegram_latency, args.timesheet_size)
+    parus_runner, parus_url = await serve(parus.app)
+    telegram_runner, telegram_url = await serve(telegram.app)
+    with tempfile.TemporaryDirectory() as directory:
+        # Настройки заменяются до импорта бота, поскольку адреса серверов читаются при импорте
+        config['websrv']['url'] = parus_url
+        config['bot']['api_server_url'] = telegram_url
+        config['sqlite']['database'] = os.path.join(directory, 'load.db')
+        config['executor']['kind'] = args.executor
+        config['sender']['rate'] = config['sender']['burst'] = args.send_rate
+        from aiogram import Bot, Dispatcher
+        from app.tsheebot.bot import bot, dp, uploads
+        import app.store.cache.models as cache_models
+        from app.store.cache.models import db as cache
+        from app.store.cache.fsm_storage import SqliteStorage
+        from app.store.websrv.models import client as websrv
+        from app.sys.executor import executor
+        Bot.set_current(bot)
+        Dispatcher.set_current(dp)
+        await cache.on_connect()
+        await websrv.on_connect()
+        await executor.on_connect()
+        await uploads.on_connect()
+        try:
+            driver = Driver(dp, args.orgs)
+            elapsed = await driver.run(args.users, args.concurrency)
+            # Ожидание загрузки принятых табелей в Парус очередью
+            started = perf_counter()
+            while await cache_models.count_uploads():
+                await asyncio.sleep(0.05)
+            drained = perf_counter() - started
+        finally:
+            await uploads.on_disconnect()
+            await executor.on_disconnect()
+            await websrv.on_disconnect()
+            if isinstance(dp.storage, SqliteStorage):
+                await dp.storage.close()
+            await cache.on_disconnect()
+            await (await bot.get_session()).close()
+            await parus_runner.cleanup()
+            await telegram_runner.cleanup()
+    report(driver, elapsed, drained, args, parus, telegram)
+
+
+def report(driver, elapsed, drained, args, parus, telegram):
+    updates = sum(len(latencies) for latencies in driver.latencies.values())
+    print(f'Пользователей: {args.users}, учреждений: {args.orgs}, параллельно: {args.concurrency}, '
+          f'задержка Паруса: {args.latency * 1000:.0f} мс, Telegram: {args.telegram_latency * 1000:.0f} мс, '
+          f'табель: {args.timesheet_size} байт, отправка: {args.send_rate} сообщений/с')
+    print(f'Обновлений: {updates} за {elapsed:.2f} с, {updates / elapsed:.1f} обновлений/с, '
+          f'очередь загрузки табелей опустела через {drained:.2f} с')
+    methods = ', '.join(f'{method}: {calls}' for method, calls in sorted(telegram.methods.items()))
+    print(f'Запросов к Парусу: {parus.requests}, методов Telegram: {methods}')
+    print(f'{"шаг":<10}{"p50, мс":>10}{"p95, мс":>10}{"p99, мс":>10}')
+    for step in (*STEPS, 'всего'):
+        latencies = sum(driver.latencies.values(), []) if step == 'всего' else driver.latencies[step]
+        print(f'{step:<10}' + ''.join(f'{value:>10.1f}' for value in percentiles(latencies)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон бота с заглушками Паруса и Telegram')
+    parser.add_argument('--users', type=int, default=200, help='количество пользователей')
+    parser.add_argument('--orgs', type=int, default=20, help='количество учреждений')
+    parser.add_argument('--concurrency', type=int, default=50, help='пользователей одновременно')
+    parser.add_argument('--latency', type=float, default=0.02, help='задержка Паруса, с')
+    parser.add_argument('--telegram-latency', type=float, default=0.005, help='задержка Telegram, с')
+    parser.add_argument('--timesheet-size', type=int, default=16384, help='размер табеля, байт')
+    parser.add_argument('--executor', choices=('thread', 'process'), default=config['executor']['kind'],
+                        help='пул вычислений для разбора табелей')
+    parser.add_argument('--send-rate', type=int, default=config['sender']['rate'],
+                        help='общее ограничение отправки сообщений в Telegram, сообщений в секунду')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
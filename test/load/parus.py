@@ -0,0 +1,94 @@
+"""
+Заглушка веб-сервиса Паруса с настраиваемой задержкой ответа и размером табеля
+"""
+
+import asyncio
+import json
+from aiohttp import web, MultipartWriter
+
+GROUPS = ['Ёжики', 'Белки', 'Зайчики']
+
+
+def org_inn(org_index) -> str:
+    return f'{org_index + 1:010d}'
+
+
+def org_code(org_index) -> str:
+    return f'DS{org_index}'
+
+
+def make_timesheet(org_index, size, author=0) -> bytes:
+    """
+    Табель посещаемости учреждения в кодировке cp1251 размером не меньше size байт
+    :param author: номер пользователя, чтобы табели разных пользователей различались
+    """
+    lines = ['Табель посещаемости;2022-09', f'{org_code(org_index)};{org_inn(org_index)};Детский сад {org_index}',
+             f'Воспитатель {author}']
+    person = 0
+    while sum(len(line) + 2 for line in lines) < size:
+        person += 1
+        lines.append(f'{GROUPS[person % len(GROUPS)]};Иванова Мария {person};' + ';'.join(['1'] * 31))
+    return '\r\n'.join(lines).encode('cp1251')
+
+
+class ParusStub:
+    """
+    Методы веб-сервиса get_orgs, get_person, get_groups, receive_timesheet и send_timesheet
+    """
+
+    def __init__(self, orgs, latency=0.0, timesheet_size=4096):
+        """
+        :param orgs: количество учреждений, ИНН учреждения с номером i равен i + 1
+        :param latency: задержка ответа в секундах
+        :param timesheet_size: размер табеля, отдаваемого receive_timesheet, в байтах
+        """
+        self.orgs = orgs
+        self.latency = latency
+        self.timesheet = make_timesheet(0, timesheet_size)
+        self.requests = 0
+        self.app = web.Application()
+        self.app.router.add_get('/{token}/get_orgs', self.get_orgs)
+        self.app.router.add_get('/{token}/get_person', self.get_person)
+        self.app.router.add_get('/{token}/get_groups', self.get_groups)
+        self.app.router.add_get('/{token}/receive_timesheet', self.receive_timesheet)
+        self.app.router.add_post('/{token}/send_timesheet', self.send_timesheet)
+
+    async def _delay(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def get_orgs(self, request):
+        await self._delay()
+        index = int(request.query['org_inn']) - 1
+        if not 0 <= index < self.orgs:
+            return web.Response(text='None')
+        return web.Response(text=json.dumps([{
+            'org_rn': index + 1, 'org_code': org_code(index), 'org_name': f'Детский сад {index}',
+            'org_inn': org_inn(index), 'company_rn': 1, 'db_key': f'db{index % 4}',
+        }]))
+
+    async def get_person(self, request):
+        await self._delay()
+        return web.Response(text=str(1000 + int(request.query['org_rn'])))
+
+    async def get_groups(self, request):
+        await self._delay()
+        return web.Response(text=';'.join(GROUPS))
+
+    async def receive_timesheet(self, request):
+        await self._delay()
+        with MultipartWriter('form-data') as root:
+            part = root.append(self.timesheet)
+            part.set_content_disposition('attachment', filename='timesheet.csv')
+        response = web.StreamResponse()
+        response.headers['Content-Type'] = root.headers['Content-Type']
+        await response.prepare(request)
+        await root.write(response)
+        await response.write_eof()
+        return response
+
+    async def send_timesheet(self, request):
+        await request.read()
+        await self._delay()
+        return web.Response(text='Табель загружен')
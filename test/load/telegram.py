@@ -0,0 +1,54 @@
+"""
+Заглушка Telegram Bot API: отвечает на методы бота и отдаёт файлы табелей, присланных пользователями
+"""
+
+import asyncio
+from time import time
+from aiohttp import web
+from test.load.parus import make_timesheet
+
+
+class TelegramStub:
+    """
+    Сервер для TelegramAPIServer.from_base: методы /bot<токен>/<метод> и файлы /file/bot<токен>/<путь>.
+    Идентификатор файла табеля имеет вид ts-<номер учреждения>-<номер пользователя>
+    """
+
+    def __init__(self, latency=0.0, timesheet_size=4096):
+        """
+        :param latency: задержка ответа в секундах
+        :param timesheet_size: размер табеля, присылаемого пользователем, в байтах
+        """
+        self.latency = latency
+        self.timesheet_size = timesheet_size
+        self.timesheets = {}
+        self.methods = {}
+        self.message_id = 0
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.router.add_post('/bot{token}/{method}', self.method)
+        self.app.router.add_get('/file/bot{token}/timesheets/{org_index}-{author}.csv', self.file)
+
+    async def method(self, request):
+        method = request.match_info['method']
+        self.methods[method] = self.methods.get(method, 0) + 1
+        data = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == 'getFile':
+            _, org_index, author = data['file_id'].split('-')
+            result = {'file_id': data['file_id'], 'file_unique_id': data['file_id'],
+                      'file_path': f'timesheets/{org_index}-{author}.csv'}
+        else:
+            self.message_id += 1
+            chat_id = int(data.get('chat_id', 0))
+            result = {'message_id': self.message_id, 'date': int(time()),
+                      'chat': {'id': chat_id, 'type': 'private'}, 'text': data.get('text', '')}
+        return web.json_response({'ok': True, 'result': result})
+
+    async def file(self, request):
+        key = int(request.match_info['org_index']), int(request.match_info['author'])
+        if key not in self.timesheets:
+            self.timesheets[key] = make_timesheet(key[0], self.timesheet_size, key[1])
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.Response(body=self.timesheets[key])
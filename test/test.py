@@ -1,5 +1,63 @@
+import asyncio
+import gc
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+import timeit
 import unittest
-from tools.cp1251 import encode_cp1251
+import zipfile
+from io import BytesIO, StringIO
+from unittest import mock
+from aiohttp import web
+from aiogram.types import InputFile
+from aiogram.utils.exceptions import RetryAfter
+from app.sys.metrics import Counter, Histogram
+from app.tsheebot.sender import ThrottledBot
+from app.tsheebot.uploads import UploadQueue
+from app.tsheebot.middlewares import DrainMiddleware, UserContextMiddleware
+import app.store.cache.models as cache
+from app.settings import config
+from app.store.cache.fsm_storage import SqliteStorage
+from app.store.cache.migrations import migrate, MIGRATIONS, SCHEMA_VERSION
+from test.load.driver import serve
+from test.load.parus import ParusStub, GROUPS
+from tools.charset import decode_timesheet, is_plausible_cyrillic
+from tools.cp1251 import cp1251, encode_cp1251, decode_cp1251, Cp1251Error, Cp1251Encoder, Cp1251Decoder
+from tools.circuit_breaker import CircuitBreaker, CLOSED, HALF_OPEN, OPEN
+from tools.hashing import HashingBuffer
+from tools.helpers import normalize_fio, split_fio
+from tools.rate_limit import TokenBucket, PriorityLimiter
+from tools.retry import retry, hedge, LatencyWindow
+from tools.singleflight import SingleFlight
+from tools.spool import Spool
+from tools.timesheet import list_archive_timesheets, prepare_timesheet, prepare_archive_timesheets
+from tools.timesheet_parser import read_header, TimesheetError
+from tools.ttl_cache import TTLCache
+
+
+def reference_encode_cp1251(utf8_string):
+    """Прежняя реализация кодирования поиском по списку"""
+    return bytes(cp1251.index(char) for char in utf8_string)
+
+
+def reference_decode_cp1251(cp1251_bytes):
+    """Прежняя реализация посимвольного декодирования"""
+    buffer = StringIO()
+    for byte in cp1251_bytes:
+        buffer.write(cp1251[byte])
+    return buffer.getvalue()
+
+
+def make_timesheet(groups=20, persons=30, days=31):
+    """Синтетический табель посещаемости нескольких групп"""
+    lines = ['Табель посещаемости;2022-09', 'ДС №5;1234567890;Детский сад «Солнышко»']
+    for g in range(groups):
+        lines.append(f'Группа №{g + 1} «Ёжики»;' + ';'.join(str(d + 1) for d in range(days)))
+        for p in range(persons):
+            lines.append(f'Иванов-Щукин Пётр Эдуардович {p};' + ';'.join('Б' if d % 7 else 'н' for d in range(days)))
+    return '\r\n'.join(lines)
 
 
 class TestSum(unittest.TestCase):
@@ -12,5 +70,973 @@ class TestSum(unittest.TestCase):
         )
 
 
+class TestHelpers(unittest.TestCase):
+
+    def test_normalize_fio(self):
+        self.assertEqual(normalize_fio('Ёлкина', ' Мария', 'ПЕТРОВНА  '), 'елкина мария петровна')
+        self.assertEqual(normalize_fio('Иванов', 'Иван', None), 'иванов иван')
+
+    def test_split_fio(self):
+        self.assertEqual(split_fio(' Иванов  Иван Петрович  оглы '), ('Иванов', 'Иван', 'Петрович оглы'))
+        self.assertEqual(split_fio('Иванов'), ('Иванов', None, None))
+
+
+class TestHashingBuffer(unittest.TestCase):
+
+    def test_hash_while_writing(self):
+        content = make_timesheet(groups=2).encode('cp1251')
+        buffer = HashingBuffer()
+        for start in range(0, len(content), 1000):
+            buffer.write(content[start:start + 1000])
+        buffer.seek(0)
+        self.assertEqual(buffer.read(), content)
+        self.assertEqual(buffer.hexdigest(), hashlib.sha256(content).hexdigest())
+
+
+class TestCp1251(unittest.TestCase):
+
+    def test_encode_equivalence(self):
+        text = ''.join(cp1251) + make_timesheet(groups=2, persons=3)
+        self.assertEqual(encode_cp1251(text), reference_encode_cp1251(text))
+
+    def test_decode_equivalence(self):
+        encoded = bytes(range(256)) + reference_encode_cp1251(make_timesheet(groups=2, persons=3))
+        self.assertEqual(decode_cp1251(encoded), reference_decode_cp1251(encoded))
+
+    def test_round_trip(self):
+        text = make_timesheet(groups=2, persons=3)
+        self.assertEqual(decode_cp1251(encode_cp1251(text)), text)
+
+    def test_unrepresentable_char(self):
+        with self.assertRaises(Cp1251Error) as context:
+            encode_cp1251('тест ✓')
+        self.assertEqual(context.exception.char, '✓')
+        self.assertEqual(context.exception.position, 5)
+        self.assertIsInstance(context.exception, ValueError)
+
+    def test_incremental(self):
+        text = make_timesheet(groups=2, persons=3)
+        chunks = [text[i:i + 7] for i in range(0, len(text), 7)]
+        encoder = Cp1251Encoder()
+        encoded = b''.join(encoder.encode(chunk) for chunk in chunks)
+        self.assertEqual(encoded, encode_cp1251(text))
+        decoder = Cp1251Decoder()
+        self.assertEqual(''.join(decoder.decode(encoded[i:i + 5]) for i in range(0, len(encoded), 5)), text)
+
+    def test_incremental_error_position(self):
+        encoder = Cp1251Encoder()
+        encoder.encode('тест')
+        with self.assertRaises(Cp1251Error) as context:
+            encoder.encode('ab✓')
+        self.assertEqual(context.exception.position, 6)
+
+    def test_benchmark(self):
+        text = make_timesheet()
+        encoded = encode_cp1251(text)
+        reference_encode = min(timeit.repeat(lambda: reference_encode_cp1251(text), number=1, repeat=3))
+        table_encode = min(timeit.repeat(lambda: encode_cp1251(text), number=1, repeat=3))
+        reference_decode = min(timeit.repeat(lambda: reference_decode_cp1251(encoded), number=1, repeat=3))
+        table_decode = min(timeit.repeat(lambda: decode_cp1251(encoded), number=1, repeat=3))
+        print(f'\ncp1251 {len(encoded)} байт: '
+              f'кодирование {reference_encode * 1000:.1f} -> {table_encode * 1000:.2f} мс '
+              f'(x{reference_encode / table_encode:.0f}), '
+              f'декодирование {reference_decode * 1000:.1f} -> {table_decode * 1000:.2f} мс '
+              f'(x{reference_decode / table_decode:.0f})')
+        self.assertLess(table_encode, reference_encode)
+        self.assertLess(table_decode, reference_decode)
+
+
+class TestCharset(unittest.TestCase):
+    text = 'Табель;ДС №5\r\nИванов Пётр;Б'
+
+    def test_cp1251_passes_through(self):
+        encoded = self.text.encode('cp1251')
+        content, cp1251_bytes, path = decode_timesheet(encoded)
+        self.assertEqual(path, 'cp1251')
+        self.assertEqual(content, self.text)
+        self.assertIs(cp1251_bytes, encoded)
+
+    def test_utf8(self):
+        for encoded in (self.text.encode('utf-8'), self.text.encode('utf-8-sig')):
+            content, cp1251_bytes, path = decode_timesheet(encoded)
+            self.assertEqual(path, 'utf-8')
+            self.assertEqual(content, self.text)
+            self.assertEqual(cp1251_bytes, self.text.encode('cp1251'))
+
+    def test_ascii(self):
+        self.assertEqual(decode_timesheet(b'a;1'), ('a;1', b'a;1', 'ascii'))
+
+    def test_fallback_detection(self):
+        content, cp1251_bytes, path = decode_timesheet(self.text.encode('utf-16'))
+        self.assertEqual(path, 'charset_normalizer')
+        self.assertEqual(cp1251_bytes, self.text.encode('cp1251'))
+
+    def test_plausibility(self):
+        self.assertTrue(is_plausible_cyrillic(self.text))
+        self.assertFalse(is_plausible_cyrillic('ЂЃ‚ѓ„…†‡'))
+
+
+class TestArchive(unittest.TestCase):
+
+    @staticmethod
+    def make_archive(files):
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, content in files.items():
+                archive.writestr(name, content)
+        return buffer.getvalue()
+
+    def test_timesheets(self):
+        timesheet = make_timesheet(groups=1, persons=2)
+        archive = self.make_archive({
+            'Ёжики.csv': timesheet.encode('cp1251'),
+            'группы/Белки.txt': timesheet.encode('utf-8'),
+            'readme.md': b'readme',
+        })
+        names = list_archive_timesheets(archive, max_entries=10)
+        self.assertEqual(len(names), 2)
+        results = prepare_archive_timesheets(archive, names, max_size=1 << 20)
+        self.assertEqual([result['filename'] for result in results], ['Ёжики.csv', 'Белки.txt'])
+        for result in results:
+            self.assertEqual(result['content'], timesheet.encode('cp1251'))
+            self.assertEqual((result['org_code'], result['org_inn']), ('ДС №5', '1234567890'))
+
+    def test_limits(self):
+        archive = self.make_archive({'a.csv': b'0' * 1000, 'b.csv': b'1'})
+        with self.assertRaises(ValueError):
+            list_archive_timesheets(archive, max_entries=1)
+        with self.assertRaises(ValueError):
+            list_archive_timesheets(b'not a zip', max_entries=10)
+        self.assertIn('error', prepare_archive_timesheets(archive, ['a.csv'], max_size=100)[0])
+
+
+class TestTimesheetParser(unittest.TestCase):
+
+    def test_header(self):
+        self.assertEqual(read_header(BytesIO(b'T\r\nDS;1234567890;name\r\n\xff')).org_inn, '1234567890')
+        for content in (b'', b'T', b'T\r\nDS', b'T\r\nDS;12345', b'T\r\n;1234567890'):
+            with self.assertRaises(TimesheetError):
+                read_header(BytesIO(content))
+        with self.assertRaises(ValueError):
+            prepare_timesheet(b'1')
+
+    def test_body_not_checked(self):
+        # Проверяются только заголовок и учреждение, строки после них не читаются
+        self.assertEqual(prepare_timesheet(b'T\r\nDS;1234567890\r\nP;1;1')[2:], ('DS', '1234567890'))
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_hit_and_miss(self):
+        cache = TTLCache(10, 60)
+        self.assertIsNone(cache.get(1))
+        cache.set(1, 'a')
+        self.assertEqual(cache.get(1), 'a')
+        self.assertEqual(cache.stats(), {'size': 1, 'hits': 1, 'misses': 1})
+
+    def test_lru_eviction(self):
+        cache = TTLCache(2, 60)
+        cache.set(1, 'a')
+        cache.set(2, 'b')
+        cache.get(1)
+        cache.set(3, 'c')
+        self.assertEqual(cache.get(1), 'a')
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl_expiry(self):
+        cache = TTLCache(10, 60)
+        with mock.patch('tools.ttl_cache.monotonic', return_value=0):
+            cache.set(1, 'a')
+        with mock.patch('tools.ttl_cache.monotonic', return_value=61):
+            self.assertEqual(cache.get(1, 'expired'), 'expired')
+        self.assertEqual(len(cache), 0)
+
+    def test_pop(self):
+        cache = TTLCache(10, 60)
+        cache.set(1, None)
+        self.assertIsNone(cache.get(1, 'missing'))
+        cache.pop(1)
+        self.assertEqual(cache.get(1, 'missing'), 'missing')
+
+
+class TestSpool(unittest.TestCase):
+
+    def test_small_content_stays_in_memory(self):
+        spool = Spool(10)
+        spool.write(b'abc')
+        spool.write(b'def')
+        spool.close()
+        self.assertTrue(spool.in_memory)
+        self.assertEqual(spool.getvalue(), b'abcdef')
+
+    def test_large_content_spools_to_disk(self):
+        spool = Spool(4)
+        for chunk in (b'abc', b'def', b'ghi'):
+            spool.write(chunk)
+        spool.close()
+        self.assertFalse(spool.in_memory)
+        with spool.open() as first, spool.open() as second:
+            self.assertEqual(first.read(4), b'abcd')
+            self.assertEqual(second.read(), b'abcdefghi')
+        path = spool.path
+        del spool
+        gc.collect()
+        self.assertFalse(os.path.exists(path))
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+
+    async def test_concurrent_calls_share_one_task(self):
+        calls = []
+
+        async def fetch(key):
+            calls.append(key)
+            await asyncio.sleep(0.01)
+            return key * 2
+
+        flight = SingleFlight('test')
+        results = await asyncio.gather(*(flight.do('a', fetch, 'a') for _ in range(5)))
+        self.assertEqual(results, ['aa'] * 5)
+        self.assertEqual(calls, ['a'])
+        self.assertFalse(flight.in_flight('a'))
+        await flight.do('a', fetch, 'a')
+        self.assertEqual(calls, ['a', 'a'])
+
+    async def test_error_is_shared(self):
+        async def fail():
+            raise RuntimeError('upstream')
+
+        flight = SingleFlight('test')
+        results = await asyncio.gather(flight.do('a', fail), flight.do('a', fail), return_exceptions=True)
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        with mock.patch('tools.rate_limit.monotonic', return_value=100.0) as clock:
+            bucket = TokenBucket(rate=2, capacity=3)
+            for _ in range(3):
+                self.assertEqual(bucket.delay(), 0)
+                bucket.take()
+            self.assertAlmostEqual(bucket.delay(), 0.5)
+            clock.return_value = 100.5
+            self.assertEqual(bucket.delay(), 0)
+
+    def test_pause(self):
+        with mock.patch('tools.rate_limit.monotonic', return_value=100.0) as clock:
+            bucket = TokenBucket(rate=10, capacity=10)
+            bucket.pause(5)
+            self.assertAlmostEqual(bucket.delay(), 5)
+            clock.return_value = 105.0
+            self.assertEqual(bucket.delay(), 0)
+            bucket.take()
+            self.assertAlmostEqual(bucket.delay(), 0.1)
+
+
+class TestPriorityLimiter(unittest.IsolatedAsyncioTestCase):
+
+    async def test_priority_order(self):
+        limiter = PriorityLimiter(rate=100, capacity=1)
+        await limiter.acquire()
+        order = []
+
+        async def send(name, priority):
+            await limiter.acquire(priority)
+            order.append(name)
+
+        await asyncio.gather(send('document', 1), send('text1', 0), send('text2', 0))
+        self.assertEqual(order, ['text1', 'text2', 'document'])
+        self.assertEqual(limiter.waiting, 0)
+
+
+class TestThrottledBot(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.bot = ThrottledBot(token='123456:' + 'A' * 35)
+        self.addAsyncCleanup((await self.bot.get_session()).close)
+
+    async def test_paused_chat_bucket_kept(self):
+        bot = self.bot
+        bucket = bot._chat_bucket(1)
+        bucket.pause(60)
+        bot._keep_chat_bucket(1, bucket)
+        # Приостановленная корзина не вытесняется по времени жизни до окончания паузы
+        with mock.patch('tools.ttl_cache.monotonic', return_value=time.monotonic() + 30):
+            self.assertIs(bot._chat_bucket(1), bucket)
+        self.assertGreater(bucket.delay(), 0)
+
+    async def test_retry_after_resends_file(self):
+        received = []
+
+        async def make_request(session, server, token, method, data=None, files=None, **kwargs):
+            # Как и aiohttp, запрос читает файл до конца и закрывает его
+            file = files['document'].file
+            received.append(file.read())
+            file.close()
+            if len(received) == 1:
+                raise RetryAfter(0)
+            return {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}}
+
+        with mock.patch('aiogram.bot.api.make_request', make_request):
+            await self.bot.send_document(1, InputFile(BytesIO(b'timesheet'), 'ts.csv'))
+        self.assertEqual(received, [b'timesheet', b'timesheet'])
+
+    async def test_retry_after_unreadable_file(self):
+        async def make_request(*args, **kwargs):
+            raise RetryAfter(0)
+
+        with mock.patch('aiogram.bot.api.make_request', make_request), self.assertRaises(RetryAfter):
+            await self.bot.send_document(1, InputFile.from_url('http://localhost/ts.csv'))
+        self.assertGreater(self.bot._chat_bucket(1).paused_until, 0)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_open_probe_close(self):
+        with mock.patch('tools.circuit_breaker.monotonic', return_value=100.0) as clock:
+            breaker = CircuitBreaker('test', failure_threshold=2, recovery_timeout=30)
+            breaker.failure()
+            breaker.success()
+            breaker.failure()
+            self.assertEqual(breaker.state, CLOSED)
+            breaker.failure()
+            self.assertEqual(breaker.state, OPEN)
+            self.assertFalse(breaker.allow())
+            clock.return_value = 130.0
+            self.assertTrue(breaker.allow())
+            self.assertEqual(breaker.state, HALF_OPEN)
+            # Пока идёт пробный вызов, остальные отклоняются
+            self.assertFalse(breaker.allow())
+            breaker.failure()
+            self.assertEqual(breaker.state, OPEN)
+            clock.return_value = 160.0
+            self.assertTrue(breaker.allow())
+            breaker.success()
+            self.assertEqual(breaker.state, CLOSED)
+            self.assertTrue(breaker.allow())
+
+
+class TestRetry(unittest.IsolatedAsyncioTestCase):
+
+    async def test_retry_until_success(self):
+        calls = []
+
+        async def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ConnectionError('upstream')
+            return 'ok'
+
+        self.assertEqual(await retry(flaky, attempts=3, base_delay=0.001, max_delay=0.01), 'ok')
+        self.assertEqual(len(calls), 3)
+
+    async def test_not_retryable(self):
+        calls = []
+
+        async def fail():
+            calls.append(1)
+            raise ValueError('bad request')
+
+        with self.assertRaises(ValueError):
+            await retry(fail, attempts=3, base_delay=0.001, max_delay=0.01,
+                        retryable=lambda error: not isinstance(error, ValueError))
+        self.assertEqual(len(calls), 1)
+
+    async def test_hedge_takes_fastest(self):
+        delays = [1, 0.01]
+
+        async def request():
+            delay = delays.pop(0)
+            await asyncio.sleep(delay)
+            return delay
+
+        self.assertEqual(await hedge(request, delay=0.02), 0.01)
+
+    def test_latency_window(self):
+        window = LatencyWindow(size=100, min_samples=10)
+        self.assertIsNone(window.quantile(0.95))
+        for value in range(1, 101):
+            window.add(value)
+        self.assertEqual(window.quantile(0.95), 95)
+
+
+class TestDrain(unittest.TestCase):
+
+    def test_drain(self):
+        async def run():
+            updates = DrainMiddleware()
+            self.assertEqual(await updates.drain(0.01), 0)
+            await updates.on_pre_process_update(None, {})
+            await updates.on_pre_process_update(None, {})
+            self.assertEqual(await updates.drain(0.01), 2)
+            await updates.on_post_process_update(None, [], {})
+            asyncio.get_running_loop().call_later(0.01, asyncio.ensure_future,
+                                                  updates.on_post_process_update(None, [], {}))
+            self.assertEqual(await updates.drain(1), 0)
+        asyncio.run(run())
+
+
+class TestUserContext(unittest.IsolatedAsyncioTestCase):
+
+    @mock.patch.object(cache, 'close_unit_of_work', new_callable=mock.AsyncMock)
+    @mock.patch.object(cache, 'get_user_context', new_callable=mock.AsyncMock, side_effect=RuntimeError('locked'))
+    @mock.patch.object(cache, 'open_unit_of_work', new_callable=mock.AsyncMock, return_value=('session', 'token'))
+    async def test_close_on_error(self, _, __, close):
+        middleware = UserContextMiddleware()
+        message = mock.Mock()
+        data = {}
+        with self.assertRaises(RuntimeError):
+            await middleware.on_pre_process_message(message, data)
+        close.assert_awaited_once_with('session', 'token')
+        await middleware.on_post_process_message(message, [], data)
+        close.assert_awaited_once()
+
+
+class SqliteTestCase(unittest.IsolatedAsyncioTestCase):
+    """Кэш SQLite во временном файле"""
+
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.database = os.path.join(directory.name, 'cache.db')
+        patcher = mock.patch.dict(config['sqlite'], database=self.database)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.users.clear()
+        cache.user_orgs.clear()
+        self.prepare_database()
+        await cache.db.on_connect()
+
+    def prepare_database(self):
+        """Содержимое базы до подключения кэша"""
+
+    async def asyncTearDown(self):
+        await cache.db.on_disconnect()
+
+
+class TestOrgs(SqliteTestCase):
+
+    @staticmethod
+    def org(org_code, org_inn, org_name, org_rn=1):
+        return dict(org_rn=org_rn, org_code=org_code, org_name=org_name, org_inn=org_inn, company_rn=1, db_key='k')
+
+    async def test_upsert(self):
+        saved = await cache.upsert_orgs([self.org('ДС1', '1234567890', 'Старое'), self.org('ДС2', '1234567890', 'Б')])
+        ids = {org['org_code']: org['id'] for org in saved}
+        saved = await cache.upsert_orgs([self.org('ДС1', '1234567890', 'Новое', org_rn=5)])
+        self.assertEqual(saved[0]['id'], ids['ДС1'])
+        self.assertEqual((saved[0]['org_name'], saved[0]['org_rn']), ('Новое', 5))
+        self.assertEqual(len(await cache.get_orgs('1234567890')), 2)
+        # Учреждение ищется по мнемокоду и ИНН одновременно
+        self.assertEqual((await cache.get_org('ДС2', '1234567890'))['id'], ids['ДС2'])
+        self.assertIsNone(await cache.get_org('ДС2', '0987654321'))
+
+    async def test_refresh_after_failure(self):
+        from app.tsheebot import models as tsheebot
+        from app.store.websrv.models import WebsrvUnavailable
+        tsheebot._orgs_refreshed.clear()
+        self.addCleanup(tsheebot._orgs_refreshed.clear)
+        with mock.patch.object(tsheebot.websrv, 'get_orgs', new_callable=mock.AsyncMock,
+                               side_effect=[WebsrvUnavailable(None, 'timeout'), [self.org('ДС1', '1234567890', 'А')]]):
+            with self.assertRaises(WebsrvUnavailable):
+                await tsheebot.get_orgs('1234567890')
+            # Сбой не откладывает следующее обновление на интервал
+            self.assertIsNone(tsheebot._orgs_refreshed.get('1234567890'))
+            self.assertEqual(len(await tsheebot.get_orgs('1234567890')), 1)
+        self.assertTrue(tsheebot._orgs_refreshed.get('1234567890'))
+
+
+class TestProcessInn(SqliteTestCase):
+
+    async def test_retry_after_outage(self):
+        from app.tsheebot import bot
+        from app.store.websrv.models import WebsrvUnavailable
+        message = mock.Mock(text='1234567890', reply=mock.AsyncMock())
+        message.from_user = mock.Mock(id=42, username='u', first_name='И', last_name='П')
+        state = mock.Mock(finish=mock.AsyncMock())
+        outage = WebsrvUnavailable('k', 'timeout')
+        with mock.patch.object(bot.tsheebot, 'get_orgs', new_callable=mock.AsyncMock, side_effect=[outage, []]):
+            with self.assertRaises(WebsrvUnavailable):
+                await bot.process_inn(message, state)
+            # Повтор ввода ИНН после недоступности Паруса не нарушает уникальность пользователя
+            message.text = '0987654321'
+            await bot.process_inn(message, state)
+        state.finish.assert_awaited_once()
+        user, _ = await cache.get_user_context(42)
+        self.assertEqual(user['org_inn'], '0987654321')
+
+    async def test_insert_resets_authorization(self):
+        [org] = await cache.upsert_orgs([TestOrgs.org('ДС1', '1234567890', 'А')])
+        await cache.insert_user({'user_id': 42, 'org_inn': '1234567890'})
+        await cache.update_user({'user_id': 42, 'org_id': org['id'], 'person_rn': 7, 'group': 'Ёжики'})
+        await cache.insert_user({'user_id': 42, 'username': 'u', 'org_inn': '0987654321'})
+        user, org = await cache.get_user_context(42)
+        self.assertEqual((user['username'], user['org_inn']), ('u', '0987654321'))
+        self.assertEqual((user['org_id'], user['person_rn'], user['group']), (None, None, None))
+        self.assertIsNone(org)
+
+
+class TestPersonLookup(SqliteTestCase):
+
+    async def get_person(self, fio, person_rn):
+        from app.tsheebot import models as tsheebot
+        with mock.patch.object(tsheebot.websrv, 'get_person', new_callable=mock.AsyncMock,
+                               return_value=person_rn) as websrv_get_person:
+            result = await tsheebot.get_person('k', 1, *split_fio(fio))
+        return result, websrv_get_person
+
+    async def test_query_normalized_whitespace(self):
+        _, websrv_get_person = await self.get_person('Ёлкина  Мария Петровна', 7)
+        websrv_get_person.assert_awaited_once_with('k', 1, 'Ёлкина', 'Мария', 'Петровна')
+
+    async def test_found_shared_by_normalized_fio(self):
+        await self.get_person('Ёлкина Мария Петровна', 7)
+        person_rn, websrv_get_person = await self.get_person('елкина  МАРИЯ петровна', None)
+        self.assertEqual(person_rn, 7)
+        websrv_get_person.assert_not_awaited()
+
+    async def test_not_found_kept_for_exact_query(self):
+        await self.get_person('Елкина Мария Петровна', None)
+        person_rn, websrv_get_person = await self.get_person('Елкина  Мария Петровна', None)
+        self.assertIsNone(person_rn)
+        websrv_get_person.assert_not_awaited()
+        # Отрицательный результат не распространяется на ФИО с ё: Парус может найти сотрудника
+        person_rn, websrv_get_person = await self.get_person('Ёлкина Мария Петровна', 7)
+        self.assertEqual(person_rn, 7)
+        websrv_get_person.assert_awaited_once()
+
+
+class TestArchiveUpload(SqliteTestCase):
+
+    async def upload(self, put):
+        from app.tsheebot import bot
+        timesheets = {f'{index}.csv': make_timesheet(groups=1, persons=index + 1) for index in range(6)}
+        timesheets['1.csv'] = timesheets['1.csv'].replace('ДС №5', 'ДС №6')
+        archive = TestArchive.make_archive({name: content.encode('cp1251') for name, content in timesheets.items()})
+
+        async def download(destination_file):
+            destination_file.write(archive)
+
+        message = mock.Mock(message_id=3, reply=mock.AsyncMock())
+        message.from_user.id = message.chat.id = 42
+        message.document = mock.Mock(file_name='табели.zip', download=download)
+        user = {'person_rn': 7}
+        org = dict(id=1, org_rn=1, org_code='ДС №5', org_inn='1234567890', db_key='k')
+        with mock.patch.object(bot.uploads, 'put', new_callable=mock.AsyncMock, side_effect=put) as queued, \
+                mock.patch.object(bot.uploads, '_reply', new_callable=mock.AsyncMock) as reply, \
+                mock.patch.dict(config['executor'], workers=4):
+            try:
+                await bot.process_timesheet_archive(message, user, org)
+            finally:
+                self.queued = [call.args[3] for call in queued.await_args_list]
+                self.indexes = [call.args[6] for call in queued.await_args_list]
+                self.report = reply.await_args.args[1].splitlines() if reply.await_args else None
+
+    async def test_order_and_org(self):
+        await self.upload(None)
+        # Табели ставятся в очередь в порядке архива, табель другого учреждения отклоняется
+        self.assertEqual(self.queued, ['0.csv', '2.csv', '3.csv', '4.csv', '5.csv'])
+        self.assertEqual(self.indexes, [0, 2, 3, 4, 5])
+        # Отчёт ожидает результаты поставленных в очередь табелей
+        self.assertIsNone(self.report)
+
+    async def test_put_failure_reported(self):
+        with self.assertRaises(RuntimeError):
+            await self.upload([None, RuntimeError('queue')])
+        self.assertEqual(self.queued, ['0.csv', '2.csv'])
+        # Отчёт отправляется, когда поставленный в очередь табель загружен
+        await cache.save_upload_batch_result(1, 0, '0.csv', True, 'загружен')
+        from app.tsheebot import bot
+        with mock.patch.object(bot.uploads, '_reply', new_callable=mock.AsyncMock) as reply:
+            await bot.uploads.report_batch(1)
+        report = reply.await_args.args[1].splitlines()
+        self.assertEqual(report[0], 'Архив табели.zip: загружено табелей 1 из 6')
+        self.assertEqual([line.split(':')[0] for line in report[1:]],
+                         ['+ 0.csv', '- 1.csv', '- 2.csv', '- 3.csv', '- 4.csv', '- 5.csv'])
+        self.assertIn('другого учреждения ДС №6', report[2])
+        # Табель, не поставленный в очередь, снова может быть загружен
+        self.assertIsNone(await cache.claim_upload_ledger('k', 1, hashlib.sha256(
+            make_timesheet(groups=1, persons=3).encode('cp1251')).hexdigest(), config['uploads']['dedup_window']))
+
+
+# Схема кэша до введения версий миграций
+BASELINE_SCHEMA = '''
+CREATE TABLE org (
+    id INTEGER NOT NULL, org_rn INTEGER NOT NULL, org_code VARCHAR NOT NULL, org_name VARCHAR NOT NULL,
+    org_inn VARCHAR NOT NULL, company_rn INTEGER NOT NULL, db_key VARCHAR NOT NULL,
+    PRIMARY KEY (id), CONSTRAINT _org_code_inn_uc UNIQUE (org_code, org_inn));
+CREATE TABLE user (
+    id INTEGER NOT NULL, user_id INTEGER NOT NULL, username VARCHAR, user_first_name VARCHAR,
+    user_last_name VARCHAR, org_inn VARCHAR, org_id INTEGER, person_rn INTEGER, family VARCHAR,
+    firstname VARCHAR, lastname VARCHAR, "group" VARCHAR,
+    PRIMARY KEY (id), CONSTRAINT _user_user_id_uc UNIQUE (user_id), FOREIGN KEY(org_id) REFERENCES org (id));
+INSERT INTO org VALUES (1, 10, 'ДС5', 'Детский сад', '1234567890', 1, 'k');
+INSERT INTO user (id, user_id, org_inn, org_id, person_rn, "group") VALUES (1, 42, '1234567890', 1, 7, 'Ёжики');
+'''
+
+
+class TestMigrations(SqliteTestCase):
+
+    def prepare_database(self):
+        with sqlite3.connect(self.database) as connection:
+            connection.executescript(BASELINE_SCHEMA)
+
+    async def schema(self):
+        async with cache.db.engine.connect() as conn:
+            version = (await conn.exec_driver_sql('PRAGMA user_version')).scalar()
+            objects = (await conn.exec_driver_sql('SELECT type, name, sql FROM sqlite_master ORDER BY name')).all()
+        return version, objects
+
+    async def test_upgrade(self):
+        self.assertEqual((await cache.get_org('ДС5', '1234567890'))['org_rn'], 10)
+        self.assertEqual((await cache.get_user(42))['group'], 'Ёжики')
+        version, objects = await self.schema()
+        self.assertEqual(version, SCHEMA_VERSION)
+        self.assertTrue({'person_lookup', 'upload_job', 'upload_ledger', 'fsm_state'} <= {row[1] for row in objects})
+        self.assertIsNotNone(await cache.enqueue_upload(dict(
+            user_id=42, chat_id=42, message_id=1, db_key='k', org_rn=10, company_rn=1,
+            filename='ts.csv', content=b'', sha256='0')))
+
+    async def test_repeat(self):
+        before = await self.schema()
+        # Повторное подключение к базе последней версии не выполняет миграции
+        await cache.db.on_disconnect()
+        migrations = [(version, mock.Mock()) for version, _ in MIGRATIONS]
+        with mock.patch('app.store.cache.migrations.MIGRATIONS', migrations):
+            await cache.db.on_connect()
+        self.assertFalse(any(migration.called for _, migration in migrations))
+        self.assertEqual(await self.schema(), before)
+        # Миграции идемпотентны и при повторном выполнении всех версий схема не изменяется
+        async with cache.db.engine.begin() as conn:
+            await conn.exec_driver_sql('PRAGMA user_version=0')
+            await conn.run_sync(migrate)
+        self.assertEqual(await self.schema(), before)
+        self.assertEqual((await cache.get_user(42))['person_rn'], 7)
+
+
+class TestQueryTiming(SqliteTestCase):
+
+    async def test_failed_statement(self):
+        from sqlalchemy import text
+        from sqlalchemy.exc import OperationalError
+        from app.sys import metrics
+        selects = metrics.sqlite_seconds.labels('select')
+        count = sum(selects.counts)
+        async with cache.db.session() as session:
+            with self.assertRaises(OperationalError):
+                await session.execute(text('select * from missing_table'))
+            await session.rollback()
+            await session.execute(text('select 1'))
+            connection = await session.connection()
+            # Время начала запроса не остаётся в соединении после ошибки
+            self.assertNotIn('query_started', connection.info)
+        self.assertEqual(sum(selects.counts), count + 1)
+
+
+class TestSqliteStorage(SqliteTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.storage = SqliteStorage()
+
+    async def count(self, table):
+        async with cache.db.engine.connect() as conn:
+            return (await conn.exec_driver_sql(f'SELECT count(*) FROM {table}')).scalar()
+
+    async def test_state_and_data(self):
+        self.assertIsNone(await self.storage.get_state(chat=1, user=2))
+        await self.storage.set_state(chat=1, user=2, state='Form:inn')
+        await self.storage.update_data(chat=1, user=2, data={'filename': 'ts.csv', 'content': b'\xc0\x00'})
+        # Состояние читается из SQLite, а не из кэша в памяти
+        self.storage.states.clear()
+        self.assertEqual(await self.storage.get_state(chat=1, user=2), 'Form:inn')
+        self.assertEqual(await self.storage.get_data(chat=1, user=2), {'filename': 'ts.csv', 'content': b'\xc0\x00'})
+        self.assertEqual(await self.count('fsm_blob'), 1)
+        await self.storage.set_data(chat=1, user=2, data={'filename': 'ts.csv'})
+        self.assertEqual(await self.count('fsm_blob'), 0)
+        await self.storage.reset_state(chat=1, user=2)
+        self.assertIsNone(await self.storage.get_state(chat=1, user=2))
+        self.assertEqual(await self.storage.get_data(chat=1, user=2), {})
+
+    async def test_sweep(self):
+        await self.storage.set_data(chat=1, user=1, data={'content': b'old'})
+        with mock.patch('app.store.cache.fsm_storage.time', return_value=time.time() + self.storage.ttl + 1):
+            await self.storage.set_data(chat=2, user=2, data={'content': b'new'})
+            self.assertEqual(await self.storage.sweep(), 1)
+        self.assertEqual(await self.count('fsm_state'), 1)
+        self.assertEqual(await self.count('fsm_blob'), 1)
+        self.assertEqual(await self.storage.get_data(chat=2, user=2), {'content': b'new'})
+
+
+class TestUploadQueue(unittest.IsolatedAsyncioTestCase):
+
+    @mock.patch.dict(config['uploads'], workers=1, poll_interval=0.01)
+    async def test_worker_survives_errors(self):
+        claims = mock.AsyncMock(side_effect=[RuntimeError('database is locked')] + [None] * 1000)
+        requeue = mock.AsyncMock(side_effect=[0] + [RuntimeError('database is locked')] * 1000)
+        with mock.patch.object(cache, 'claim_upload', claims), \
+                mock.patch.object(cache, 'requeue_expired_uploads', requeue), \
+                mock.patch.object(cache, 'purge_upload_ledger', mock.AsyncMock()), \
+                mock.patch.object(cache, 'take_lost_uploads', mock.AsyncMock(return_value=[])), \
+                self.assertLogs(level='ERROR'):
+            queue = UploadQueue(mock.Mock())
+            await queue.on_connect()
+            await asyncio.sleep(0.1)
+            self.assertFalse(queue._workers[0].done())
+            self.assertGreater(claims.await_count, 2)
+            await queue.on_disconnect()
+
+
+class TestUploadJobs(SqliteTestCase):
+
+    @staticmethod
+    async def enqueue(user_id, db_key='k', **job):
+        return await cache.enqueue_upload(dict(
+            dict(user_id=user_id, chat_id=user_id, message_id=1, db_key=db_key, org_rn=1, company_rn=1,
+                 filename=f'{user_id}.csv', content=b'', sha256=None), **job))
+
+    async def test_user_order(self):
+        first = await self.enqueue(1)
+        second = await self.enqueue(1)
+        other = await self.enqueue(2)
+        self.assertEqual((await cache.claim_upload('w1', 60, 10))['id'], first)
+        # Следующее задание пользователя ждёт завершения предыдущего, задания других пользователей выполняются
+        self.assertEqual((await cache.claim_upload('w2', 60, 10))['id'], other)
+        self.assertIsNone(await cache.claim_upload('w3', 60, 10))
+        await cache.delete_upload(first)
+        self.assertEqual((await cache.claim_upload('w3', 60, 10))['id'], second)
+
+    async def test_db_key_limit(self):
+        for user_id in range(3):
+            await self.enqueue(user_id, db_key='a')
+        other = await self.enqueue(3, db_key='b')
+        running = [await cache.claim_upload('w', 60, 2) for _ in range(2)]
+        self.assertEqual([job['db_key'] for job in running], ['a', 'a'])
+        self.assertEqual((await cache.claim_upload('w', 60, 2))['id'], other)
+        self.assertIsNone(await cache.claim_upload('w', 60, 2))
+        await cache.delete_upload(running[0]['id'])
+        self.assertEqual((await cache.claim_upload('w', 60, 2))['user_id'], 2)
+
+    async def test_lease_and_defer(self):
+        job_id = await self.enqueue(1)
+        job = await cache.claim_upload('w1', -1, 10)
+        self.assertEqual((job['worker'], job['attempts']), ('w1', 1))
+        # Аренда истекла: задание возвращается в очередь и берётся заново
+        self.assertIsNone(await cache.claim_upload('w2', 60, 10))
+        self.assertEqual(await cache.requeue_expired_uploads(), 1)
+        job = await cache.claim_upload('w2', 60, 10)
+        self.assertEqual((job['id'], job['worker'], job['attempts']), (job_id, 'w2', 2))
+        self.assertEqual(await cache.requeue_expired_uploads(), 0)
+        # Отложенное задание не берётся до истечения задержки
+        await cache.defer_upload(job_id, 60)
+        self.assertIsNone(await cache.claim_upload('w3', 60, 10))
+        await cache.defer_upload(job_id, -1)
+        self.assertEqual((await cache.claim_upload('w3', 60, 10))['attempts'], 3)
+
+    async def test_batch(self):
+        batch_id = await cache.create_upload_batch(
+            dict(user_id=1, chat_id=1, message_id=1, filename='pack.zip', total=3))
+        await cache.save_upload_batch_result(batch_id, 0, 'bad.csv', False, 'ошибка чтения табеля')
+        for index in (1, 2):
+            await self.enqueue(1, batch_id=batch_id, batch_index=index, filename=f'{index}.csv')
+        later = await self.enqueue(1)
+        # Табели архива загружаются одновременно, следующее задание пользователя ждёт весь архив
+        jobs = [await cache.claim_upload('w', 60, 10) for _ in range(2)]
+        self.assertEqual([job['batch_index'] for job in jobs], [1, 2])
+        self.assertIsNone(await cache.claim_upload('w', 60, 10))
+        queue = UploadQueue(mock.AsyncMock())
+        with mock.patch('app.tsheebot.models.send_timesheet', mock.AsyncMock(return_value='Табель загружен')):
+            for job in jobs:
+                await queue._run(job)
+        queue.bot.send_message.assert_awaited_once()
+        report = queue.bot.send_message.await_args.args[1]
+        self.assertEqual(report.splitlines(), [
+            'Архив pack.zip: загружено табелей 2 из 3', '- bad.csv: ошибка чтения табеля',
+            '+ 1.csv: Табель загружен', '+ 2.csv: Табель загружен'])
+        self.assertIsNone(await cache.take_complete_upload_batch(batch_id))
+        self.assertEqual((await cache.claim_upload('w', 60, 10))['id'], later)
+
+    async def test_lost_upload_not_resent(self):
+        await cache.claim_upload_ledger('k', 1, 'hash', 3600)
+        await self.enqueue(1, sha256='hash')
+        await self.enqueue(2)
+        # Исполнители остановлены по истечении аренды: первый во время отправки в Парус, второй до неё
+        sent = await cache.claim_upload('w', -1, 10)
+        await cache.mark_upload_sending(sent['id'])
+        await cache.claim_upload('w', -1, 10)
+        queue = UploadQueue(mock.AsyncMock())
+        await queue._recover()
+        queue.bot.send_message.assert_awaited_once()
+        self.assertIn('результат неизвестен', queue.bot.send_message.await_args.args[1])
+        # Табель с неизвестным результатом можно отправить повторно, прерванное до отправки задание повторяется
+        self.assertIsNone(await cache.get_upload_ledger('k', 1, 'hash', 3600))
+        self.assertEqual((await cache.claim_upload('w', 60, 10))['user_id'], 2)
+        self.assertEqual(await cache.count_uploads(), 1)
+
+
+class TestUploadLedger(SqliteTestCase):
+
+    async def test_claim(self):
+        self.assertIsNone(await cache.claim_upload_ledger('k', 1, 'hash', 3600))
+        previous = await cache.claim_upload_ledger('k', 1, 'hash', 3600)
+        self.assertIsNone(previous['result'])
+        await cache.save_upload_result('k', 1, 'hash', 'Табель загружен')
+        self.assertEqual((await cache.claim_upload_ledger('k', 1, 'hash', 3600))['result'], 'Табель загружен')
+        # Тот же табель в другое учреждение загружается
+        self.assertIsNone(await cache.claim_upload_ledger('k', 2, 'hash', 3600))
+
+    async def test_expiry_and_delete(self):
+        self.assertIsNone(await cache.claim_upload_ledger('k', 1, 'hash', 3600))
+        later = time.time() + 3601
+        with mock.patch('app.store.cache.models.time', return_value=later):
+            self.assertIsNone(await cache.get_upload_ledger('k', 1, 'hash', 3600))
+            # По истечении dedup_window табель снова записывается в журнал
+            self.assertIsNone(await cache.claim_upload_ledger('k', 1, 'hash', 3600))
+            self.assertIsNotNone(await cache.claim_upload_ledger('k', 1, 'hash', 3600))
+        # После неудачной загрузки запись удаляется и табель можно отправить повторно
+        await cache.delete_upload_ledger('k', 1, 'hash')
+        self.assertIsNone(await cache.claim_upload_ledger('k', 1, 'hash', 3600))
+        self.assertIsNotNone(await cache.get_upload_ledger('k', 1, 'hash', 3600))
+
+    async def test_purge(self):
+        await cache.claim_upload_ledger('k', 1, 'old', 3600)
+        with mock.patch('app.store.cache.models.time', return_value=time.time() + 3601):
+            await cache.claim_upload_ledger('k', 1, 'new', 3600)
+            await cache.purge_upload_ledger(3600)
+            self.assertIsNone(await cache.get_upload_ledger('k', 1, 'old', 7200))
+            self.assertIsNotNone(await cache.get_upload_ledger('k', 1, 'new', 3600))
+
+    async def test_enqueue_failure_releases_claim(self):
+        from app.tsheebot import bot
+        org = {'db_key': 'k', 'org_rn': 1, 'company_rn': 1}
+        with mock.patch.object(bot.uploads, 'put', mock.AsyncMock(side_effect=RuntimeError('database is locked'))):
+            with self.assertRaises(RuntimeError):
+                await bot.send_timesheet(mock.AsyncMock(), mock.AsyncMock(), org, b'ts', 'ts.csv', 'hash')
+        self.assertIsNone(await cache.get_upload_ledger('k', 1, 'hash', 3600))
+
+
+class TestWebsrvStub(SqliteTestCase):
+    """Обращения к веб-сервису через заглушку Паруса из нагрузочного прогона"""
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        import app.store.websrv.models as websrv
+        from app.tsheebot import models as tsheebot
+        self.websrv = websrv
+        self.tsheebot = tsheebot
+        # Ответы методов, заменяющие ответы заглушки: endpoint -> (статус, текст)
+        self.faults = {}
+        self.calls = {}
+
+        @web.middleware
+        async def faults(request, handler):
+            endpoint = request.path.rsplit('/', 1)[-1]
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            if endpoint in self.faults:
+                status, text = self.faults[endpoint]
+                return web.Response(status=status, text=text)
+            return await handler(request)
+
+        self.parus = ParusStub(orgs=2, latency=0.01)
+        self.parus.app.middlewares.append(faults)
+        runner, url = await serve(self.parus.app)
+        self.addAsyncCleanup(runner.cleanup)
+        for patcher in (mock.patch.object(websrv, 'websrv_url', f'{url}/token'),
+                        mock.patch.dict(config['websrv']['hedge'], enabled=False),
+                        mock.patch.dict(config['websrv']['retry'], base_delay=0.01, max_delay=0.01),
+                        mock.patch.dict(websrv.breakers, clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for memory_cache in (tsheebot.groups_cache, tsheebot.timesheets_cache):
+            memory_cache.clear()
+            self.addCleanup(memory_cache.clear)
+        await websrv.client.on_connect()
+        self.addAsyncCleanup(websrv.client.on_disconnect)
+
+    def count(self, endpoint):
+        return self.calls.get(endpoint, 0)
+
+    async def test_lookup_not_found(self):
+        self.assertEqual(await self.websrv.get_orgs('9999999999'), [])
+        self.faults['get_person'] = (404, '')
+        self.assertIsNone(await self.websrv.get_person('db0', 1, 'Иванов', 'Иван', None))
+        self.faults['get_groups'] = (200, '')
+        self.assertEqual(await self.websrv.get_groups('db0', 1), [])
+        # Отрицательный ответ - не сбой Паруса
+        self.assertEqual(self.websrv.breakers['db0'].state, CLOSED)
+
+    async def test_lookup_failure(self):
+        self.faults['get_person'] = (400, 'bad request')
+        with self.assertRaises(self.websrv.WebsrvUnavailable) as error:
+            await self.websrv.get_person('db0', 1, 'Иванов', 'Иван', None)
+        self.assertFalse(error.exception.retryable)
+        self.assertEqual(self.count('get_person'), 1)
+        self.faults['get_groups'] = (503, 'unavailable')
+        with self.assertRaises(self.websrv.WebsrvUnavailable) as error:
+            await self.websrv.get_groups('db0', 1)
+        self.assertTrue(error.exception.retryable)
+        self.assertEqual(self.count('get_groups'), config['websrv']['retry']['attempts'])
+
+    async def test_groups_persisted(self):
+        from app.tsheebot import bot
+        message = mock.Mock(reply=mock.AsyncMock())
+        org = {'db_key': 'db0', 'org_rn': 1}
+        await bot.prompt_to_input_group(message, mock.Mock(), {}, org)
+        keyboard = message.reply.await_args.kwargs['reply_markup'].keyboard
+        self.assertEqual([button for row in keyboard for button in row], GROUPS)
+        # После перезапуска процесса группы читаются из SQLite без запроса к Парусу
+        self.tsheebot.groups_cache.clear()
+        await bot.prompt_to_input_group(message, mock.Mock(), {}, org)
+        self.assertEqual(self.count('get_groups'), 1)
+        await self.tsheebot.invalidate_groups('db0', 1)
+        self.assertEqual(await self.tsheebot.get_groups('db0', 1), GROUPS)
+        self.assertEqual(self.count('get_groups'), 2)
+
+    async def test_groups_single_flight(self):
+        results = await asyncio.gather(*(self.tsheebot.get_groups('db0', 1) for _ in range(10)))
+        self.assertEqual(results, [GROUPS] * 10)
+        self.assertEqual(self.count('get_groups'), 1)
+
+    async def test_timesheet_generation(self):
+        org = {'db_key': 'db0', 'org_rn': 1, 'company_rn': 1}
+        for _ in range(2):
+            content, filename, status, _ = await self.tsheebot.receive_timesheet('db0', 1, GROUPS[0])
+            self.assertEqual((filename, status), ('timesheet.csv', 200))
+        self.assertEqual(self.count('receive_timesheet'), 1)
+        # Загрузка табеля в учреждение делает прежние табели учреждения недоступными
+        self.assertEqual(await self.tsheebot.send_timesheet(org, b'timesheet', 'timesheet.csv'), 'Табель загружен')
+        await self.tsheebot.receive_timesheet('db0', 1, GROUPS[0])
+        self.assertEqual(self.count('receive_timesheet'), 2)
+        # Табели другого учреждения остаются в кэше
+        await self.tsheebot.receive_timesheet('db0', 2, GROUPS[0])
+        self.tsheebot.invalidate_timesheets('db0', 1)
+        await self.tsheebot.receive_timesheet('db0', 2, GROUPS[0])
+        self.assertEqual(self.count('receive_timesheet'), 3)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter(self):
+        counter = Counter('test_requests_total', 'Запросы', ['endpoint', 'status'])
+        counter.labels('get_orgs', 200).inc()
+        counter.labels('get_orgs', 200).inc(2)
+        self.assertIs(counter.labels('get_orgs', 200), counter.labels('get_orgs', 200))
+        self.assertEqual(list(counter.render())[2], 'test_requests_total{endpoint="get_orgs",status="200"} 3')
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('test_seconds', 'Длительность', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value)
+        self.assertEqual(list(histogram.render())[2:], [
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 5.65',
+            'test_seconds_count 4',
+        ])
+
+
 if __name__ == '__main__':
     unittest.main()
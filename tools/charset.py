@@ -0,0 +1,71 @@
+"""
+Определение кодировки табеля посещаемости
+Мобильное приложение формирует табели в cp1251 либо utf-8, поэтому полное определение кодировки
+выполняется только если ни одна из них не подходит
+"""
+
+import re
+from tools.cp1251 import encode_cp1251, decode_cp1251
+
+# Символы, ожидаемые в тексте на русском языке помимо ASCII
+CYRILLIC_CHARS = frozenset(
+    [chr(code) for code in range(0x0410, 0x0450)] + ['Ё', 'ё', '№', '«', '»', '–', '—', '…', ' '])
+# Минимальная доля ожидаемых символов среди символов вне ASCII
+CYRILLIC_RATIO = 0.9
+
+# Управляющие символы, которых не бывает в текстовом табеле в однобайтовой кодировке или utf-8
+CONTROL_BYTES = re.compile(rb'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def is_plausible_cyrillic(content) -> bool:
+    """
+    Проверка правдоподобия русского текста
+    :param content: строка
+    :return: True - символы вне ASCII в основном кириллические
+    """
+    non_ascii = [char for char in content if ord(char) > 0x7F]
+    if not non_ascii:
+        return True
+    cyrillic = sum(1 for char in non_ascii if char in CYRILLIC_CHARS)
+    return cyrillic >= CYRILLIC_RATIO * len(non_ascii)
+
+
+def decode_timesheet(encoded) -> tuple[str, bytes, str]:
+    """
+    Декодирование табеля в кодировке cp1251 либо utf-8
+    :param encoded: массив байтов табеля
+    :return: кортеж (строка, массив байтов в кодировке cp1251, способ определения кодировки)
+    """
+    if CONTROL_BYTES.search(encoded):
+        # Например, utf-16
+        path = 'charset_normalizer'
+        content = _detect(encoded)
+        cp1251_bytes = encode_cp1251(content)
+    elif encoded.isascii():
+        path = 'ascii'
+        content, cp1251_bytes = encoded.decode('ascii'), encoded
+    else:
+        try:
+            content = encoded.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            content = decode_cp1251(encoded)
+            if is_plausible_cyrillic(content):
+                # Табель уже в cp1251 и передаётся без перекодирования
+                path = 'cp1251'
+                cp1251_bytes = encoded
+            else:
+                path = 'charset_normalizer'
+                content = _detect(encoded)
+                cp1251_bytes = encode_cp1251(content)
+        else:
+            path = 'utf-8'
+            cp1251_bytes = encode_cp1251(content)
+    return content, cp1251_bytes, path
+
+
+def _detect(encoded) -> str:
+    from charset_normalizer import from_bytes
+    best = from_bytes(encoded).best()
+    if best is None:
+        raise ValueError('Не удалось определить кодировку табеля')
+    return str(best)
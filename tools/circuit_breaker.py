@@ -0,0 +1,60 @@
+"""
+Автоматический выключатель вызовов неисправного сервиса
+"""
+
+import logging
+from time import monotonic
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """
+    После failure_threshold ошибок подряд выключатель размыкается и вызовы отклоняются без обращения к сервису.
+    Через recovery_timeout секунд пропускается один пробный вызов: успех замыкает выключатель,
+    ошибка снова размыкает его
+    """
+
+    def __init__(self, name, failure_threshold, recovery_timeout):
+        """
+        :param name: имя для журнала
+        :param failure_threshold: количество ошибок подряд до размыкания
+        :param recovery_timeout: время в секундах до пробного вызова
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self) -> bool:
+        """Разрешение вызова"""
+        if self.state == CLOSED:
+            return True
+        now = monotonic()
+        if now - self.opened_at < self.recovery_timeout:
+            return False
+        # Следующий пробный вызов разрешается не раньше чем через recovery_timeout, даже если текущий завис
+        self.opened_at = now
+        self._set_state(HALF_OPEN)
+        return True
+
+    def success(self):
+        self.failures = 0
+        if self.state != CLOSED:
+            self._set_state(CLOSED)
+
+    def failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            self.opened_at = monotonic()
+            self._set_state(OPEN)
+
+    def _set_state(self, state):
+        if state != self.state:
+            log = logging.info if state == CLOSED else logging.warning
+            log(f'Выключатель {self.name}: {self.state} -> {state}, ошибок подряд: {self.failures}')
+            self.state = state
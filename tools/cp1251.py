@@ -2,7 +2,7 @@
 Функции для кодирования и декодирования кодировки cp1251
 """
 
-from io import StringIO
+import codecs
 
 
 cp1251 = [
@@ -40,6 +40,20 @@ cp1251 = [
   '\u0448', '\u0449', '\u044A', '\u044B', '\u044C', '\u044D', '\u044E', '\u044F',
 ]
 
+# Таблицы перекодировки, построенные один раз при загрузке модуля
+decoding_table = ''.join(cp1251)
+encoding_table = codecs.charmap_build(decoding_table)
+
+
+class Cp1251Error(ValueError):
+    """Символ не представим в кодировке cp1251"""
+
+    def __init__(self, char, position):
+        self.char = char
+        self.position = position
+        super().__init__(f'Символ "{char}" (U+{ord(char):04X}) в позиции {position} '
+                         f'не представим в кодировке cp1251')
+
 
 def encode_cp1251(utf8_string):
     """
@@ -47,7 +61,10 @@ def encode_cp1251(utf8_string):
     :param utf8_string: строка в кодировке utf-8
     :return: массив байтов в кодировке cp1251
     """
-    return bytes(cp1251.index(char) for char in utf8_string)
+    try:
+        return codecs.charmap_encode(utf8_string, 'strict', encoding_table)[0]
+    except UnicodeEncodeError as error:
+        raise Cp1251Error(error.object[error.start], error.start) from None
 
 
 def decode_cp1251(cp1251_bytes):
@@ -56,7 +73,65 @@ def decode_cp1251(cp1251_bytes):
     :param cp1251_bytes: массив байтов в кодировке cp1251
     :return: строка в кодировке utf-8
     """
-    buffer = StringIO()
-    for byte in cp1251_bytes:
-        buffer.write(cp1251[byte])
-    return buffer.getvalue()
+    return codecs.charmap_decode(cp1251_bytes, 'strict', decoding_table)[0]
+
+
+class Cp1251Encoder:
+    """Потоковое кодирование в cp1251 по частям"""
+
+    def __init__(self):
+        self.position = 0
+
+    def encode(self, chunk):
+        """
+        Кодирование очередной части потока
+        :param chunk: часть строки в кодировке utf-8
+        :return: часть массива байтов в кодировке cp1251
+        """
+        try:
+            encoded = encode_cp1251(chunk)
+        except Cp1251Error as error:
+            raise Cp1251Error(error.char, self.position + error.position) from None
+        self.position += len(chunk)
+        return encoded
+
+    def reset(self):
+        self.position = 0
+
+
+class Cp1251Decoder:
+    """Потоковое декодирование из cp1251 по частям"""
+
+    def decode(self, chunk):
+        """
+        Декодирование очередной части потока
+        :param chunk: часть массива байтов в кодировке cp1251
+        :return: часть строки в кодировке utf-8
+        """
+        # Однобайтовая кодировка: части потока декодируются независимо
+        return decode_cp1251(chunk)
+
+    def reset(self):
+        pass
+
+
+def iterencode_cp1251(chunks):
+    """
+    Кодирование потока строк в cp1251
+    :param chunks: итератор частей строки в кодировке utf-8
+    :return: итератор частей массива байтов в кодировке cp1251
+    """
+    encoder = Cp1251Encoder()
+    for chunk in chunks:
+        yield encoder.encode(chunk)
+
+
+def iterdecode_cp1251(chunks):
+    """
+    Декодирование потока байтов из cp1251
+    :param chunks: итератор частей массива байтов в кодировке cp1251
+    :return: итератор частей строки в кодировке utf-8
+    """
+    decoder = Cp1251Decoder()
+    for chunk in chunks:
+        yield decoder.decode(chunk)
@@ -0,0 +1,25 @@
+"""
+Хеширование содержимого по мере его получения
+"""
+
+import hashlib
+from io import BytesIO
+
+
+class HashingBuffer(BytesIO):
+    """
+    Буфер в памяти, вычисляющий SHA-256 записываемого содержимого по частям,
+    чтобы не читать содержимое повторно после загрузки.
+    Рассчитан на последовательную запись без перезаписи ранее записанных частей
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._hash = hashlib.sha256()
+
+    def write(self, chunk):
+        self._hash.update(chunk)
+        return super().write(chunk)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
@@ -5,14 +5,23 @@
 
 def split_fio(fio):
     """
-    Разделение строки "Фамилия Имя Отчество" на кортеж (Фамилия, Имя, Отчество)
+    Разделение строки "Фамилия Имя Отчество" на кортеж (Фамилия, Имя, Отчество) без лишних пробелов
     :param fio: строка ФИО
     :return: кортеж ФИО
     """
-    fio_split = fio.split(' ', 2)
+    fio_split = ' '.join(fio.split()).split(' ', 2)
     return tuple(fio_split[i] if len(fio_split) > i else None for i in range(3))
 
 
+def normalize_fio(family, firstname, lastname):
+    """
+    ФИО для сравнения: нижний регистр, ё заменена на е, одиночные пробелы между словами
+    :return: строка "фамилия имя отчество"
+    """
+    words = ' '.join(part for part in (family, firstname, lastname) if part).split()
+    return ' '.join(words).lower().replace('ё', 'е')
+
+
 def temp_filepath(filename):
     from os.path import join
     from tempfile import gettempdir
@@ -0,0 +1,106 @@
+"""
+Ограничение частоты операций: корзина токенов и очередь с приоритетами поверх неё
+"""
+
+import asyncio
+import contextvars
+from heapq import heappush, heappop
+from itertools import count
+from time import monotonic
+
+
+class TokenBucket:
+    """
+    Корзина токенов: пополняется со скоростью rate в секунду до ёмкости capacity,
+    каждая операция забирает один токен
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        :param rate: токенов в секунду
+        :param capacity: ёмкость корзины, допустимый всплеск операций
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Время в секундах до появления токена, 0 - токен есть"""
+        now = monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        """Расход токена, наличие которого проверено методом delay"""
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        """Приостановка выдачи токенов, например по требованию сервера повторить запрос позже"""
+        self.paused_until = max(self.paused_until, monotonic() + seconds)
+        # После паузы доступен один токен, дальнейшее пополнение начинается с окончания паузы
+        self.tokens = 1
+        self.updated = self.paused_until
+
+    async def acquire(self):
+        """Ожидание и расход токена"""
+        while (delay := self.delay()) > 0:
+            await asyncio.sleep(delay)
+        self.take()
+
+
+class PriorityLimiter:
+    """
+    Выдача токенов общей корзины ожидающим в порядке приоритета, при равном приоритете - в порядке очереди.
+    Пока очереди нет и токены есть, токен выдаётся сразу
+    """
+
+    def __init__(self, rate, capacity):
+        self.bucket = TokenBucket(rate, capacity)
+        self._waiters = []
+        self._order = count()
+        self._task = None
+
+    async def acquire(self, priority=0):
+        """
+        Ожидание токена
+        :param priority: приоритет, меньшее значение обслуживается раньше
+        """
+        if not self._waiters and self.bucket.delay() == 0:
+            self.bucket.take()
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heappush(self._waiters, (priority, next(self._order), waiter))
+        if self._task is None:
+            # Задача общая для нескольких обновлений, поэтому выполняется в пустом контексте
+            self._task = contextvars.Context().run(asyncio.ensure_future, self._run())
+        await waiter
+
+    def pause(self, seconds):
+        self.bucket.pause(seconds)
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def _run(self):
+        try:
+            while self._waiters:
+                delay = self.bucket.delay()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                _, _, waiter = heappop(self._waiters)
+                # Ожидание могло быть отменено
+                if not waiter.done():
+                    self.bucket.take()
+                    waiter.set_result(None)
+        finally:
+            self._task = None
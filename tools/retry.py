@@ -0,0 +1,76 @@
+"""
+Повтор идемпотентных вызовов с экспоненциальной задержкой и дублирование медленных вызовов
+"""
+
+import asyncio
+import random
+from collections import deque
+from typing import Optional
+
+
+async def retry(func, attempts, base_delay, max_delay, retryable=lambda error: True):
+    """
+    Вызов с повторами после ошибки
+    Задержка перед повтором выбирается случайно от 0 до base_delay * 2 ** номер попытки, но не больше max_delay,
+    чтобы повторы многих клиентов не приходили на сервис одновременно
+    :param func: асинхронная функция без аргументов
+    :param attempts: максимальное количество попыток
+    :param retryable: функция, определяющая по исключению, имеет ли смысл повтор
+    """
+    for attempt in range(attempts):
+        try:
+            return await func()
+        except Exception as error:
+            if attempt + 1 == attempts or not retryable(error):
+                raise
+            await asyncio.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+
+
+async def hedge(func, delay: Optional[float]):
+    """
+    Вызов с дублированием: если за delay секунд результата нет, запускается второй такой же вызов
+    и используется результат первого успешно завершившегося. Оставшийся вызов отменяется
+    :param func: асинхронная функция без аргументов
+    :param delay: задержка дублирования, None - без дублирования
+    """
+    if delay is None:
+        return await func()
+    tasks = [asyncio.ensure_future(func())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            tasks.append(asyncio.ensure_future(func()))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            succeeded = [task for task in done if task.exception() is None]
+            if succeeded:
+                return succeeded[0].result()
+        # Оба вызова завершились ошибкой
+        return tasks[0].result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+class LatencyWindow:
+    """Длительности последних вызовов для оценки квантилей"""
+
+    def __init__(self, size, min_samples):
+        """
+        :param size: количество хранимых длительностей
+        :param min_samples: минимальное количество длительностей для оценки квантиля
+        """
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+
+    def add(self, value):
+        self._samples.append(value)
+
+    def quantile(self, q) -> Optional[float]:
+        """Квантиль длительности, None - недостаточно данных"""
+        if len(self._samples) < self.min_samples:
+            return None
+        samples = sorted(self._samples)
+        return samples[int(q * (len(samples) - 1))]
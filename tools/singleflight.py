@@ -0,0 +1,50 @@
+"""
+Объединение одновременных вызовов с одинаковым ключом в один
+"""
+
+import asyncio
+import contextvars
+import logging
+from functools import partial
+
+
+class SingleFlight:
+    """
+    Одновременные вызовы с одинаковым ключом ожидают одну и ту же задачу.
+    Задача выполняется в пустом контексте, поскольку она общая для нескольких обновлений Telegram
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+
+    def start(self, key, func, *args) -> asyncio.Task:
+        """
+        Запуск задачи без ожидания результата, если задача с таким ключом ещё не выполняется
+        :param key: ключ вызова
+        :param func: асинхронная функция
+        :param args: аргументы функции
+        :return: выполняющаяся задача
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = contextvars.Context().run(asyncio.ensure_future, func(*args))
+            self._calls[key] = task
+            task.add_done_callback(partial(self._done, key))
+        return task
+
+    async def do(self, key, func, *args):
+        """
+        Выполнение задачи с ожиданием результата
+        Отмена ожидающего не отменяет общую задачу
+        """
+        return await asyncio.shield(self.start(key, func, *args))
+
+    def in_flight(self, key) -> bool:
+        return key in self._calls
+
+    def _done(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled() and task.exception():
+            logging.warning(f'{self.name} {key}: {task.exception()!r}')
@@ -0,0 +1,76 @@
+"""
+Буфер содержимого файла в памяти до порога и во временном файле на диске выше порога
+"""
+
+import os
+import weakref
+from io import BytesIO
+from uuid import uuid4
+from tools.helpers import temp_filepath
+
+
+class Spool:
+    """
+    Содержимое файла, записываемое частями.
+    Пока размер не превышает порог, содержимое хранится в памяти, затем переносится во временный файл.
+    Временный файл удаляется вместе с объектом
+    """
+
+    def __init__(self, threshold):
+        """
+        :param threshold: порог размера содержимого в памяти в байтах
+        """
+        self.threshold = threshold
+        self.size = 0
+        self.path = None
+        self._buffer = bytearray()
+        self._content = None
+        self._file = None
+
+    def write(self, chunk):
+        """Запись очередной части содержимого"""
+        self.size += len(chunk)
+        if self._file is None and self.size > self.threshold:
+            self.path = temp_filepath(f'tsheebot-{uuid4().hex}')
+            self._file = open(self.path, 'wb')
+            weakref.finalize(self, _remove_file, self.path)
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+        if self._file is None:
+            self._buffer += chunk
+        else:
+            self._file.write(chunk)
+
+    def close(self):
+        """Завершение записи"""
+        if self._file is None:
+            self._content = bytes(self._buffer)
+            self._buffer = bytearray()
+        else:
+            self._file.close()
+
+    @property
+    def in_memory(self) -> bool:
+        return self.path is None
+
+    def open(self):
+        """
+        Открытие содержимого для чтения
+        Каждый вызов возвращает независимый файловый объект
+        """
+        if self.in_memory:
+            return BytesIO(self._content)
+        else:
+            return open(self.path, 'rb')
+
+    def getvalue(self) -> bytes:
+        """Всё содержимое в виде массива байтов"""
+        with self.open() as file:
+            return file.read()
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
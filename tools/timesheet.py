@@ -0,0 +1,97 @@
+"""
+Обработка табеля посещаемости
+"""
+
+import hashlib
+import os
+import zipfile
+import zlib
+from io import BytesIO
+from tools.charset import decode_timesheet
+from tools.timesheet_parser import read_header
+
+# Расширения файлов табелей
+TIMESHEET_EXTENSIONS = ('.csv', '.txt')
+# Размер части распаковываемого файла архива
+ARCHIVE_CHUNK_SIZE = 65536
+# Признак имени файла в UTF-8 в заголовке ZIP
+_ZIP_UTF8_FLAG = 0x800
+
+
+def prepare_timesheet(encoded) -> tuple[bytes, str, str, str]:
+    """
+    Подготовка табеля к отправке в Парус с проверкой заголовка табеля
+    Функция выполняется в пуле потоков или процессов
+    :param encoded: массив байтов табеля в кодировке cp1251 либо utf-8
+    :return: кортеж (массив байтов в кодировке cp1251, способ определения кодировки, мнемокод, ИНН)
+    :raise ValueError: табель в неизвестной кодировке либо нарушена структура заголовка
+    """
+    _, cp1251_bytes, charset_path = decode_timesheet(encoded)
+    header = read_header(BytesIO(cp1251_bytes))
+    return cp1251_bytes, charset_path, header.org_code, header.org_inn
+
+
+def _entry_name(info: zipfile.ZipInfo) -> str:
+    # Архиваторы Windows записывают имена в cp866 без признака UTF-8, а zipfile читает их как cp437
+    if info.flag_bits & _ZIP_UTF8_FLAG:
+        return info.filename
+    try:
+        return info.filename.encode('cp437').decode('cp866')
+    except UnicodeError:
+        return info.filename
+
+
+def list_archive_timesheets(archive, max_entries) -> list[str]:
+    """
+    Список табелей в архиве ZIP по оглавлению архива без распаковки
+    :param archive: массив байтов архива
+    :param max_entries: максимальное количество табелей
+    :return: имена файлов табелей в архиве
+    :raise ValueError: архив повреждён либо содержит слишком много табелей
+    """
+    try:
+        with zipfile.ZipFile(BytesIO(archive)) as zip_file:
+            names = [info.filename for info in zip_file.infolist()
+                     if not info.is_dir() and os.path.splitext(info.filename)[1].lower() in TIMESHEET_EXTENSIONS]
+    except zipfile.BadZipFile as error:
+        raise ValueError(f'архив повреждён: {error}')
+    if len(names) > max_entries:
+        raise ValueError(f'в архиве {len(names)} табелей, допускается не больше {max_entries}')
+    return names
+
+
+def _read_entry(zip_file, name, max_size) -> bytes:
+    """Распаковка файла архива частями с ограничением размера распакованного содержимого"""
+    chunks = []
+    size = 0
+    with zip_file.open(name) as file:
+        while chunk := file.read(ARCHIVE_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_size:
+                raise ValueError(f'размер табеля больше {max_size} байт')
+            chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def prepare_archive_timesheets(archive, names, max_size) -> list[dict]:
+    """
+    Распаковка и подготовка к отправке в Парус части табелей архива
+    Функция выполняется в пуле потоков или процессов, архив передаётся в пул один раз на часть табелей
+    :param archive: массив байтов архива ZIP
+    :param names: имена файлов табелей в архиве
+    :param max_size: максимальный размер распакованного табеля в байтах
+    :return: для каждого табеля словарь filename, content, sha256, charset_path, org_code, org_inn
+    либо filename и error с описанием ошибки
+    """
+    results = []
+    with zipfile.ZipFile(BytesIO(archive)) as zip_file:
+        for name in names:
+            filename = os.path.basename(_entry_name(zip_file.getinfo(name)))
+            try:
+                content, charset_path, org_code, org_inn = prepare_timesheet(_read_entry(zip_file, name, max_size))
+            except (ValueError, TypeError, RuntimeError, NotImplementedError, zipfile.BadZipFile, zlib.error) as error:
+                results.append({'filename': filename, 'error': str(error) or repr(error)})
+            else:
+                results.append({'filename': filename, 'content': content, 'sha256': hashlib.sha256(content).hexdigest(),
+                                'charset_path': charset_path, 'org_code': org_code, 'org_inn': org_inn})
+    return results
@@ -0,0 +1,73 @@
+"""
+Чтение и проверка заголовка табеля посещаемости в кодировке cp1251
+Табель читается из потока байтов по строкам, строки после заголовка не читаются:
+
+    заголовок;период
+    мнемокод учреждения;ИНН;наименование
+"""
+
+from tools.cp1251 import decode_cp1251
+
+SEPARATOR = ';'
+INN_LENGTH = 10
+
+
+class TimesheetError(ValueError):
+    """Нарушение структуры заголовка табеля"""
+
+    def __init__(self, line_number, reason):
+        super().__init__(f'строка {line_number}: {reason}' if line_number else reason)
+        self.line_number = line_number
+        self.reason = reason
+
+
+class Header:
+    __slots__ = ('title', 'period', 'org_code', 'org_inn', 'org_name')
+
+    def __init__(self, title, period, org_code, org_inn, org_name):
+        self.title = title
+        self.period = period
+        self.org_code = org_code
+        self.org_inn = org_inn
+        self.org_name = org_name
+
+
+def _lines(stream):
+    """Непустые строки потока байтов cp1251 с номерами строк"""
+    for line_number, line in enumerate(stream, 1):
+        line = line.rstrip(b'\r\n')
+        if line.strip():
+            yield line_number, decode_cp1251(line)
+
+
+def _next_line(lines, what):
+    try:
+        return next(lines)
+    except StopIteration:
+        raise TimesheetError(None, f'нет строки: {what}')
+
+
+def _read_header(lines) -> Header:
+    line_number, line = _next_line(lines, 'заголовок табеля')
+    title, _, period = line.partition(SEPARATOR)
+    if not title.strip():
+        raise TimesheetError(line_number, 'пустой заголовок табеля')
+    line_number, line = _next_line(lines, 'учреждение')
+    fields = line.split(SEPARATOR)
+    if len(fields) < 2:
+        raise TimesheetError(line_number, 'ожидаются мнемокод и ИНН учреждения')
+    org_code, org_inn = fields[0], fields[1]
+    if not org_code:
+        raise TimesheetError(line_number, 'пустой мнемокод учреждения')
+    if not (org_inn.isdigit() and len(org_inn) == INN_LENGTH):
+        raise TimesheetError(line_number, f'ИНН учреждения должен содержать {INN_LENGTH} цифр')
+    return Header(title, period.rstrip(SEPARATOR), org_code, org_inn, fields[2] if len(fields) > 2 else '')
+
+
+def read_header(stream) -> Header:
+    """
+    Чтение заголовка табеля без чтения групп
+    :param stream: поток байтов табеля в кодировке cp1251
+    :raise TimesheetError: нарушена структура заголовка
+    """
+    return _read_header(_lines(stream))
@@ -0,0 +1,65 @@
+"""
+Ограниченный по размеру кэш в памяти с временем жизни записей
+"""
+
+from collections import OrderedDict
+from time import monotonic
+
+
+class TTLCache:
+    """
+    Кэш с вытеснением давно не использованных записей (LRU) и временем жизни записей (TTL)
+    """
+
+    def __init__(self, maxsize, ttl):
+        """
+        :param maxsize: максимальное количество записей
+        :param ttl: время жизни записи в секундах
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Получение значения по ключу
+        :param key: ключ
+        :param default: значение, возвращаемое при отсутствии ключа или истечении времени жизни
+        :return: значение из кэша либо default
+        """
+        item = self._data.get(key)
+        if item is not None:
+            value, expires = item
+            if expires > monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        """
+        Сохранение значения по ключу с вытеснением самой старой записи при переполнении
+        :param ttl: время жизни записи в секундах, если оно отличается от времени жизни кэша
+        """
+        self._data[key] = (value, monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        """Удаление значения по ключу"""
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        """Статистика попаданий и промахов"""
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._data)